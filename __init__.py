@@ -18,7 +18,7 @@ from wizard import (
     UpdateMagentoCatalogStart, UpdateMagentoCatalog,
     ExportMagentoCatalogStart, ExportMagentoCatalog,
 )
-from channel import Channel, MagentoTier
+from channel import Channel, MagentoTier, ChannelException
 from party import Party, MagentoWebsiteParty, Address
 from product import (
     Category, MagentoInstanceCategory, Product,
@@ -28,7 +28,7 @@ from country import Country, Subdivision
 from currency import Currency
 from carrier import MagentoInstanceCarrier
 from sale import (
-    Sale, StockShipmentOut, SaleLine
+    Sale, StockShipmentOut, SaleLine, MagentoOrderPayload
 )
 from bom import BOM
 from tax import MagentoTax, MagentoTaxRelation
@@ -41,6 +41,7 @@ def register():
     Pool.register(
         Channel,
         MagentoTier,
+        ChannelException,
         MagentoInstanceCarrier,
         TestMagentoConnectionStart,
         ImportStoresStart,
@@ -66,6 +67,7 @@ def register():
         ImportMagentoCarriersStart,
         ExportMagentoOrderStatusStart,
         SaleLine,
+        MagentoOrderPayload,
         BOM,
         MagentoTax,
         MagentoTaxRelation,
@@ -7,8 +7,19 @@
     :copyright: (c) 2013 by Openlabs Technologies & Consulting (P) Limited
     :license: BSD, see LICENSE for more details.
 """
+import sys
+import time
+import xmlrpclib
+import threading
+from collections import deque
+from contextlib import contextmanager
+from itertools import islice
+
 from magento.api import API
 
+#: Fault code sent by magento when the session used for a call has expired
+SESSION_EXPIRED_FAULT = 5
+
 
 class Core(API):
     """
@@ -87,3 +98,222 @@ class OrderConfig(API):
                          ]
         """
         return self.call('sales_order.shipping_methods', [])
+
+
+def multicall(api, calls, batch_size):
+    """
+    Send the given calls to magento using multiCall, `batch_size` calls in
+    each request.
+
+    A fault raised by a call is returned as an `xmlrpclib.Fault` in place of
+    its result instead of being raised, so that it fails only that call and
+    not the rest of its batch.
+
+    :param api: Logged in API
+    :param calls: List of [<resource path>, <arguments>] calls
+    :param batch_size: Number of calls to send in a single request
+    :return: Iterator over the results in the same order as the calls
+    """
+    for index in xrange(0, len(calls), batch_size):
+        for result in api.multiCall(calls[index:index + batch_size]):
+            if isinstance(result, dict) and result.get('isFault'):
+                result = xmlrpclib.Fault(
+                    result.get('faultCode'), result.get('faultMessage')
+                )
+            yield result
+
+
+def threaded_imap(function, iterable, max_workers):
+    """
+    Like `itertools.imap`, but each call of the function is run in a thread
+    of its own with at most `max_workers` calls running at a time. The
+    results are yielded in the order of the items as soon as they are
+    available, so that the caller can work on a result while the next ones
+    are being fetched.
+
+    The function must not use the Tryton transaction, which belongs to the
+    thread of the caller.
+
+    If a call raises, the exception is raised when its result is reached.
+
+    :param function: Function called with each item
+    :param iterable: Items to call the function with
+    :param max_workers: Maximum number of calls running at a time
+    :return: Iterator over the results
+    """
+    items = iter(iterable)
+    pending = deque()
+
+    def start(item):
+        outcome = {}
+
+        def run():
+            try:
+                outcome['result'] = function(item)
+            except Exception:
+                outcome['error'] = sys.exc_info()
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        pending.append((thread, outcome))
+
+    for item in islice(items, max(max_workers, 1)):
+        start(item)
+    while pending:
+        thread, outcome = pending.popleft()
+        thread.join()
+        # Keep max_workers calls running while the result is being used
+        for item in islice(items, 1):
+            start(item)
+        if 'error' in outcome:
+            exc_type, exc_value, exc_traceback = outcome['error']
+            raise exc_type, exc_value, exc_traceback
+        yield outcome['result']
+
+
+class PooledSession(object):
+    """
+    An authenticated API lent by the :class:`SessionPool`.
+
+    Attribute access is delegated to the API. If a call fails because the
+    session has expired on magento, a new login is done on the same API and
+    the call is retried once.
+    """
+
+    def __init__(self, api, session):
+        self._api = api
+        self._session = session
+
+    def __getattr__(self, name):
+        attr = getattr(self._session, name)
+        if not callable(attr):
+            return attr
+
+        def call_with_relogin(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            except xmlrpclib.Fault, fault:
+                if fault.faultCode != SESSION_EXPIRED_FAULT:
+                    raise
+                self._api.__enter__()
+                return attr(*args, **kwargs)
+        return call_with_relogin
+
+
+class SessionPool(object):
+    """
+    A thread safe pool of logged in magento API sessions.
+
+    Sessions are pooled by API class and credentials (url, user, key), so
+    that repeated calls to the same magento instance do not pay for a
+    `login` and `endSession` round trip each time. Sessions which stay idle
+    longer than `idle_timeout` seconds are closed and evicted.
+
+    Example usage::
+
+        with session_pool.session(magento.Order, url, user, key) as api:
+            order_data = api.info(increment_id)
+    """
+
+    def __init__(self, idle_timeout=300, max_idle=4):
+        """
+        :param idle_timeout: Seconds after which an unused session is closed
+        :param max_idle: Maximum number of idle sessions kept per key
+        """
+        self.idle_timeout = idle_timeout
+        self.max_idle = max_idle
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def session(self, api_class, url, user, key):
+        """
+        Lend a logged in session of `api_class` for the given credentials.
+        The session is given back to the pool when the block exits, unless
+        the connection broke in between in which case it is dropped.
+        """
+        pool_key = (api_class, url, user, key)
+        api, session = self._acquire(pool_key)
+        broken = False
+        try:
+            yield PooledSession(api, session)
+        except (IOError, xmlrpclib.ProtocolError):
+            # The connection is in an unknown state, do not reuse it
+            broken = True
+            raise
+        finally:
+            if broken:
+                self._close(api)
+            else:
+                self._release(pool_key, api, session)
+
+    def _acquire(self, pool_key):
+        """
+        Return an idle (api, session) pair for the key or login a new one
+        """
+        with self._lock:
+            expired = self._pop_expired()
+            idle = self._idle.get(pool_key)
+            entry = idle.pop() if idle else None
+
+        for api, _, _ in expired:
+            self._close(api)
+
+        if entry is not None:
+            return entry[:2]
+
+        api_class, url, user, key = pool_key
+        api = api_class(url, user, key)
+        return api, api.__enter__()
+
+    def _release(self, pool_key, api, session):
+        """
+        Give back the session to the pool
+        """
+        with self._lock:
+            idle = self._idle.setdefault(pool_key, [])
+            if len(idle) < self.max_idle:
+                idle.append((api, session, time.time()))
+                return
+        self._close(api)
+
+    def _pop_expired(self):
+        """
+        Remove and return the entries idle for longer than `idle_timeout`.
+        Must be called with the lock held.
+        """
+        threshold = time.time() - self.idle_timeout
+        expired = []
+        for pool_key, idle in self._idle.items():
+            expired.extend(entry for entry in idle if entry[2] < threshold)
+            idle[:] = [entry for entry in idle if entry[2] >= threshold]
+            if not idle:
+                del self._idle[pool_key]
+        return expired
+
+    def _close(self, api):
+        """
+        End the session on magento, ignoring network errors since the
+        session will expire on its own anyway
+        """
+        try:
+            api.__exit__(None, None, None)
+        except (IOError, xmlrpclib.Error):
+            pass
+
+    def clear(self):
+        """
+        Close all the idle sessions in the pool
+        """
+        with self._lock:
+            entries = [
+                entry for idle in self._idle.values() for entry in idle
+            ]
+            self._idle.clear()
+        for api, _, _ in entries:
+            self._close(api)
+
+
+#: Sessions shared by every channel in this process
+session_pool = SessionPool()
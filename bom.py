@@ -63,6 +63,7 @@ class BOM:
         :return: Found or created BoM's active record
         """
         Uom = Pool().get('product.uom')
+        ModelData = Pool().get('ir.model.data')
         ProductBom = Pool().get('product.product-production.bom')
         Channel = Pool().get('sale.channel')
 
@@ -73,16 +74,19 @@ class BOM:
 
         channel = Channel.get_current_magento_channel()
 
+        # Import the bundles and their components at once
+        products = channel.import_products_using_skus([
+            item['sku'] for data in identified_boms.itervalues()
+            for item in [data['bundle']] + data['components']
+        ])
+
         for item_id, data in identified_boms.iteritems():
-            bundle_product = \
-                channel.import_product(data['bundle']['sku'])
+            bundle_product = products[data['bundle']['sku']]
 
             # It contains a list of tuples, in which the first element is the
             # product's active record and second is its quantity in the BoM
             child_products = [(
-                channel.import_product(
-                    each['sku']
-                ), (
+                products[each['sku']], (
                     float(each['qty_ordered']) /
                     float(data['bundle']['qty_ordered'])
                 )
@@ -107,7 +111,7 @@ class BOM:
                     break
             else:
                 # No matching BoM found, create a new one
-                unit, = Uom.search([('name', '=', 'Unit')])
+                unit = Uom(ModelData.get_id('product', 'uom_unit'))
                 bom, = cls.create([{
                     'name': bundle_product.name,
                     'inputs': [('create', [{
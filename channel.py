@@ -5,19 +5,25 @@
     :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
     :license: see LICENSE for more details.
 """
-from datetime import datetime
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+import hashlib
+import json
 import magento
 import xmlrpclib
 import socket
+from itertools import chain, izip
 
+from trytond import backend
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Eval
 from trytond.model import ModelView, ModelSQL, fields
-from .api import OrderConfig
+from trytond.tools import grouped_slice
+from .api import OrderConfig, session_pool, multicall, threaded_imap
 
 __metaclass__ = PoolMeta
-__all__ = ['Channel', 'MagentoTier']
+__all__ = ['Channel', 'MagentoTier', 'ChannelException']
 
 MAGENTO_STATES = {
     'invisible': ~(Eval('source') == 'magento'),
@@ -28,6 +34,56 @@ INVISIBLE_IF_NOT_MAGENTO = {
     'invisible': ~(Eval('source') == 'magento'),
 }
 
+#: Number of order summaries fetched in a page while importing orders
+ORDER_PAGE_SIZE = 3000
+
+#: Number of products imported between commits while importing products
+PRODUCT_PAGE_SIZE = 500
+
+#: Fields of the channel which change the tier prices of all its listings
+PRICE_RULE_FIELDS = ('price_list', 'default_uom', 'magento_price_tiers')
+
+#: Time by which an import of orders paginated by order id starts before
+#: the previous import started, to allow for the clocks of magento and
+#: tryton to differ
+ORDER_UPDATE_OVERLAP = timedelta(minutes=10)
+
+
+def has_savepoint():
+    """
+    Check if the database backend supports savepoints. The python 2 sqlite
+    driver commits the transaction before a savepoint, so savepoints are
+    not used on sqlite.
+    """
+    return backend.name() != 'sqlite'
+
+
+@contextmanager
+def savepoint(name):
+    """
+    Run the block in a savepoint of the current transaction. If the block
+    raises, everything it wrote is rolled back and the exception is raised
+    again, the rest of the transaction is kept.
+
+    Without savepoints, see `has_savepoint`, the block is run as is and
+    what it wrote before raising is not rolled back.
+    """
+    cursor = Transaction().cursor
+    if not has_savepoint():
+        yield
+        return
+
+    cursor.execute('SAVEPOINT "%s"' % name)
+    try:
+        yield
+    except Exception:
+        cursor.execute('ROLLBACK TO SAVEPOINT "%s"' % name)
+        # The records cached by the block may not exist anymore
+        for cache in cursor.cache.itervalues():
+            cache.clear()
+        raise
+    cursor.execute('RELEASE SAVEPOINT "%s"' % name)
+
 
 class Channel:
     """
@@ -100,6 +156,70 @@ class Channel:
     product_listings = fields.One2Many(
         'product.product.channel_listing', 'channel', 'Product Listings',
     )
+    magento_multicall_batch_size = fields.Integer(
+        'MultiCall Batch Size', help='Number of calls sent to magento in a '
+        'single multiCall request, for example the number of orders '
+        'fetched in one request while importing orders.',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_order_fetch_concurrency = fields.Integer(
+        'Concurrent Order Requests', help='Number of requests sent to '
+        'magento at a time to fetch the data of orders. Keep it low for '
+        'hosts which cannot take much parallel load.',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_orders_per_commit = fields.Integer(
+        'Orders Per Commit', help='If set, each order is imported in a '
+        'savepoint and the import is committed after these many orders. '
+        'An order which fails to import is logged as a channel exception '
+        'and skipped instead of stopping the import, except on databases '
+        'without savepoints like sqlite.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_merge_guest_customers = fields.Boolean(
+        'Merge Guest Customers', help='If checked, the orders placed by '
+        'guests with the same email are imported for a single party '
+        'instead of a new party for each order.',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_order_pagination = fields.Selection([
+        ('page', 'Page Number'),
+        ('keyset', 'Order ID'),
+    ], 'Order Pagination', help='How the orders to import are paginated. '
+        'Paginating by order ID keeps every page equally fast on large '
+        'stores and resumes an import which was stopped.',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    magento_last_order_updated_at = fields.DateTime(
+        'Last Order Updated At', readonly=True,
+        help='Latest update time, as given by magento, of the orders '
+        'imported when paginating by order ID',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_last_order_id = fields.Integer(
+        'Last Order ID', readonly=True,
+        help='ID of the last order imported by an import paginating by '
+        'order ID which has not finished yet',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_product_fetch_concurrency = fields.Integer(
+        'Concurrent Product Requests', help='Number of requests sent to '
+        'magento at a time to fetch the data of products. Keep it low for '
+        'hosts which cannot take much parallel load.',
+        states=MAGENTO_STATES, depends=['source']
+    )
+    last_product_update_time = fields.DateTime(
+        'Last Product Update Time', help='Products changed on magento '
+        'since this time are updated by the next catalog update, all the '
+        'products are updated if it is empty',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
+    magento_last_product_id = fields.Integer(
+        'Last Product ID', readonly=True,
+        help='ID of the last product imported by a product import which '
+        'has not finished yet',
+        states=INVISIBLE_IF_NOT_MAGENTO, depends=['source']
+    )
 
     @classmethod
     def __setup__(cls):
@@ -112,7 +232,22 @@ class Channel:
                 'unique_magento_channel',
                     'UNIQUE(magento_url, magento_website_id, magento_store_id)',
                 'This store is already added'
-            )
+            ),
+            (
+                'magento_multicall_batch_size_positive',
+                'CHECK(magento_multicall_batch_size > 0)',
+                'MultiCall batch size must be greater than zero'
+            ),
+            (
+                'magento_order_fetch_concurrency_positive',
+                'CHECK(magento_order_fetch_concurrency > 0)',
+                'Concurrent order requests must be greater than zero'
+            ),
+            (
+                'magento_product_fetch_concurrency_positive',
+                'CHECK(magento_product_fetch_concurrency > 0)',
+                'Concurrent product requests must be greater than zero'
+            ),
         ]
         cls._error_messages.update({
             "connection_error": "Incorrect API Settings! \n"
@@ -132,6 +267,8 @@ class Channel:
         })
         cls._error_messages.update({
             "missing_magento_channel": 'Magento channel is not in context',
+            "orders_not_sorted_by_id": 'Magento did not list the orders by '
+                'order ID. Use the page number to paginate orders.',
         })
 
     def validate_magento_channel(self):
@@ -165,6 +302,34 @@ class Channel:
         """
         return 1
 
+    @staticmethod
+    def default_magento_multicall_batch_size():
+        """
+        Sets default number of calls sent in a multiCall request
+        """
+        return 100
+
+    @staticmethod
+    def default_magento_order_pagination():
+        """
+        Sets default pagination of orders to import
+        """
+        return 'page'
+
+    @staticmethod
+    def default_magento_order_fetch_concurrency():
+        """
+        Sets default number of requests sent at a time to fetch orders
+        """
+        return 1
+
+    @staticmethod
+    def default_magento_product_fetch_concurrency():
+        """
+        Sets default number of requests sent at a time to fetch products
+        """
+        return 1
+
     def get_taxes(self, rate):
         "Return list of tax records with the given rate"
         for mag_tax in self.magento_taxes:
@@ -183,10 +348,7 @@ class Channel:
 
         with Transaction().set_context({'current_channel': self.id}):
             # Import order states
-            with OrderConfig(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as order_config_api:
+            with self.get_magento_session(OrderConfig) as order_config_api:
                 order_states_data = order_config_api.get_states()
                 for code, name in order_states_data.iteritems():
                     self.create_order_state(code, name)
@@ -209,6 +371,8 @@ class Channel:
         # Make sure channel belongs to magento
         self.validate_magento_channel()
 
+        # A fresh login is done here instead of using the session pool
+        # since the point is to check the credentials
         try:
             with magento.API(
                 self.magento_url, self.magento_api_user,
@@ -220,6 +384,24 @@ class Channel:
         ):
             self.raise_user_error("connection_error")
 
+    def get_magento_session(self, api_class):
+        """
+        Returns a context manager which lends a logged in session of the
+        given API class for this channel from the session pool. Sessions are
+        reused across calls instead of doing a login for every call.
+
+        Example usage::
+
+            with channel.get_magento_session(magento.Order) as order_api:
+                order_api.info(increment_id)
+
+        :param api_class: Magento API class, eg: `magento.Order`
+        """
+        return session_pool.session(
+            api_class, self.magento_url, self.magento_api_user,
+            self.magento_api_key
+        )
+
     @classmethod
     @ModelView.button_action('magento.wizard_import_magento_carriers')
     def import_magento_carriers(cls, channels):
@@ -233,9 +415,8 @@ class Channel:
         for channel in channels:
             channel.validate_magento_channel()
             with Transaction().set_context({'current_channel': channel.id}):
-                with OrderConfig(
-                    channel.magento_url, channel.magento_api_user,
-                    channel.magento_api_key
+                with channel.get_magento_session(
+                    OrderConfig
                 ) as order_config_api:
                     mag_carriers = order_config_api.get_shipping_methods()
 
@@ -260,25 +441,102 @@ class Channel:
         Import products for this magento channel
 
         Downstream implementation for channel.import_products
+
+        The products are imported in pages of `PRODUCT_PAGE_SIZE` products
+        in the order of their magento ID, and the import is committed after
+        each page. The data of the products which do not exist yet is
+        fetched with multiCall requests, see :meth:`get_magento_data`. If the
+        import stops, the next import resumes after the last page imported.
+
+        :return: List of ids of the products imported
         """
         if self.source != 'magento':
             return super(Channel, self).import_products()
 
         self.import_category_tree()
 
+        filters = {}
+        if self.magento_last_product_id:
+            filters['product_id'] = {'gt': self.magento_last_product_id}
+
+        product_ids = []
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Product(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as product_api:
-                # TODO: Implement pagination and import each product as async
-                # task
-                magento_products = product_api.list()
+            with self.get_magento_session(magento.Product) as product_api:
+                magento_products = product_api.list(filters)
+            magento_products.sort(
+                key=lambda magento_product: int(magento_product['product_id'])
+            )
+
+            for index in xrange(0, len(magento_products), PRODUCT_PAGE_SIZE):
+                page = magento_products[index:index + PRODUCT_PAGE_SIZE]
+                product_ids.extend(self.import_products_using_magento_data(
+                    page
+                ))
+                self.magento_last_product_id = int(page[-1]['product_id'])
+                self.save()
+                Transaction().cursor.commit()
+
+        self.magento_last_product_id = None
+        self.save()
+
+        return product_ids
+
+    def import_products_using_magento_data(self, magento_products):
+        """
+        Import the given products. The products which already exist are
+        found at once and the data of the missing ones is fetched with
+        multiCall requests. A product which cannot be fetched is logged as a
+        channel exception and skipped.
+
+        :param magento_products: List of product data from magento lists,
+                                 with at least the sku
+        :return: List of ids of the products found or created
+        """
+        Product = Pool().get('product.product')
+        ChannelException = Pool().get('channel.exception')
+
+        skus = [magento_product['sku'] for magento_product in magento_products]
+        products = Product.find_all_using_magento_skus(skus)
+        missing_skus = []
+        for sku in skus:
+            if sku not in products:
+                # Also keeps a SKU listed twice from being fetched twice
+                products[sku] = None
+                missing_skus.append(sku)
+
+        for sku, product_data in izip(missing_skus, self.get_magento_data(
+            magento.Product, [
+                ['catalog_product.info', [sku]] for sku in missing_skus
+            ], self.magento_product_fetch_concurrency
+        )):
+            if isinstance(product_data, xmlrpclib.Fault):
+                ChannelException.create([{
+                    'origin': '%s,%s' % (self.__name__, self.id),
+                    'log': "Error occurred on fetching product %s.\nError "
+                        "Message: %s" % (sku, product_data.faultString),
+                    'channel': self.id,
+                }])
+                continue
+            products[sku] = Product.create_using_magento_data(product_data)
+
+        return [products[sku].id for sku in skus if products[sku]]
+
+    def import_products_using_skus(self, skus):
+        """
+        Import the products of the given SKUs for this magento channel. The
+        products which already exist are found at once and only the missing
+        ones are imported with :meth:`import_product`.
 
-                products = []
-                for magento_product in magento_products:
-                    products.append(self.import_product(magento_product['sku']))
+        :param skus: List of product SKUs from magento
+        :return: Dictionary of the products with their SKU as key
+        """
+        Product = Pool().get('product.product')
 
-        return map(int, products)
+        products = Product.find_all_using_magento_skus(skus)
+        for sku in skus:
+            if sku not in products:
+                products[sku] = self.import_product(sku)
+        return products
 
     def import_product(self, sku):
         """
@@ -296,16 +554,90 @@ class Channel:
         if not product:
             # if product is not found get the info from magento and
             # delegate to create_using_magento_data
-            with magento.Product(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as product_api:
+            with self.get_magento_session(magento.Product) as product_api:
                 product_data = product_api.info(sku)
 
             product = Product.create_using_magento_data(product_data)
 
         return product
 
+    def update_magento_products(self):
+        """
+        Update the products listed on this channel which changed on magento
+        since `last_product_update_time`. The changed products are found
+        with an `updated_at` filter on the product list and their data is
+        fetched with multiCall requests, see :meth:`get_magento_data`. A
+        product which cannot be fetched is logged as a channel exception and
+        skipped.
+
+        :return: List of active records of products updated
+        """
+        ChannelListing = Pool().get('product.product.channel_listing')
+        ChannelException = Pool().get('channel.exception')
+
+        self.validate_magento_channel()
+
+        update_time = datetime.utcnow()
+        filters = {}
+        if self.last_product_update_time:
+            filters['updated_at'] = {
+                'gteq': self.last_product_update_time.strftime(
+                    '%Y-%m-%d %H:%M:%S'
+                )
+            }
+
+        products = []
+        with Transaction().set_context({'current_channel': self.id}):
+            with self.get_magento_session(magento.Product) as product_api:
+                magento_products = product_api.list(filters)
+
+            # Only the products listed on this channel are updated
+            identifiers = [
+                str(magento_product['product_id'])
+                for magento_product in magento_products
+            ]
+            listings = {}
+            for sub_identifiers in grouped_slice(identifiers):
+                for listing in ChannelListing.search([
+                    ('channel', '=', self.id),
+                    ('product_identifier', 'in', list(sub_identifiers)),
+                ]):
+                    listings[listing.product_identifier] = listing
+            identifiers = [
+                identifier for identifier in identifiers
+                if identifier in listings
+            ]
+
+            for identifier, product_data in izip(
+                identifiers, self.get_magento_data(
+                    magento.Product, [
+                        ['catalog_product.info', [identifier]]
+                        for identifier in identifiers
+                    ], self.magento_product_fetch_concurrency
+                )
+            ):
+                if isinstance(product_data, xmlrpclib.Fault):
+                    ChannelException.create([{
+                        'origin': '%s,%s' % (self.__name__, self.id),
+                        'log': (
+                            "Error occurred on fetching product %s.\n"
+                            "Error Message: %s" % (
+                                identifier, product_data.faultString
+                            )
+                        ),
+                        'channel': self.id,
+                    }])
+                    continue
+                product = listings[identifier].product
+                products.append(
+                    product.update_from_magento_using_data(product_data)
+                )
+
+        self.last_product_update_time = update_time
+        self.save()
+
+        return products
+
     def import_category_tree(self):
         """
         Imports the category tree and creates categories in a hierarchy same as
@@ -318,10 +650,7 @@ class Channel:
         self.validate_magento_channel()
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Category(
-                self.magento_url, self.magento_api_user,
-                self.magento_api_key
-            ) as category_api:
+            with self.get_magento_session(magento.Category) as category_api:
                 category_tree = category_api.tree(
                     self.magento_root_category_id
                 )
@@ -336,60 +665,379 @@ class Channel:
         if self.source != 'magento':
             return super(Channel, self).import_orders()
 
-        OrderState = Pool().get('sale.channel.order_state')
-
         new_sales = []
         with Transaction().set_context({'current_channel': self.id}):
-            order_states = OrderState.search([
-                ('channel', '=', self.id),
-            ])
-            order_states_to_import_in = map(
-                lambda state: state.code, order_states
-            )
+            # Orders are imported a page at a time so that only one page of
+            # orders is held in memory and the orders of a page are
+            # committed before the next page is fetched
+            for orders_summaries in self.get_magento_order_pages():
+                new_sales.extend(
+                    self.import_orders_using_magento_data(orders_summaries)
+                )
+                Transaction().cursor.commit()
+        return new_sales
 
-            if not order_states_to_import_in:
-                self.raise_user_error("states_not_found")
-
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
-                # Filter orders with date and store_id using list()
-                # then get info of each order using info()
-                # and call find_or_create_using_magento_data on sale
-                filter = {
-                    'store_id': {'=': self.magento_store_id},
-                    'state': {'in': order_states_to_import_in},
-                }
-                if self.last_order_import_time:
-                    last_order_import_time = \
-                        self.last_order_import_time.replace(
-                            microsecond=0
-                        )
-                    filter.update({
-                        'updated_at': {
-                            'gteq': last_order_import_time.isoformat(' ')
-                        },
-                    })
-                self.write([self], {
-                    'last_order_import_time': datetime.utcnow()
-                })
-                page = 1
-                has_next = True
-                orders_summaries = []
-                while has_next:
-                    # XXX: Pagination is only available in
-                    # magento extension >= 1.6.1
-                    api_res = order_api.search(
-                        filters=filter, limit=3000, page=page
-                    )
-                    has_next = api_res['hasNext']
-                    page += 1
-                    orders_summaries.extend(api_res['items'])
-
-                for order_summary in orders_summaries:
-                    new_sales.append(self.import_order(order_summary))
+    def download_magento_orders(self):
+        """
+        Download the orders to import from magento into the order payloads
+        without creating sales for them. This is the network stage of
+        `import_orders`, the sales are created by
+        `process_magento_order_payloads`.
+
+        :return: List of active record of order payloads downloaded
+        """
+        Sale = Pool().get('sale.sale')
+
+        self.validate_magento_channel()
+
+        payloads = []
+        with Transaction().set_context({'current_channel': self.id}):
+            for orders_summaries in self.get_magento_order_pages():
+                existing_sales = Sale.find_all_using_magento_data(
+                    orders_summaries
+                )
+                payloads.extend(self.stage_magento_orders([
+                    order_summary for order_summary in orders_summaries
+                    if int(order_summary['order_id']) not in existing_sales
+                ]))
+                Transaction().cursor.commit()
+        return payloads
+
+    def process_magento_order_payloads(self):
+        """
+        Create sales from the pending order payloads of this channel. This
+        is the processing stage of `import_orders` and does not connect to
+        magento, so a failed run can be replayed as often as needed.
+
+        :return: List of active record of sale imported
+        """
+        Payload = Pool().get('magento.order.payload')
+
+        self.validate_magento_channel()
+
+        payloads = Payload.search([
+            ('channel', '=', self.id),
+            ('state', '=', 'pending'),
+        ], order=[('id', 'ASC')])
+
+        new_sales = []
+        for sub_payloads in grouped_slice(payloads):
+            new_sales.extend(Payload.process(list(sub_payloads)))
+            Transaction().cursor.commit()
         return new_sales
 
+    @classmethod
+    def download_magento_orders_using_cron(cls):
+        """
+        Download orders into the order payloads from all magento channels
+        using cron
+        """
+        for channel in cls.search([('source', '=', 'magento')]):
+            channel.download_magento_orders()
+
+    @classmethod
+    def process_magento_order_payloads_using_cron(cls):
+        """
+        Create sales from the pending order payloads of all magento channels
+        using cron
+        """
+        for channel in cls.search([('source', '=', 'magento')]):
+            channel.process_magento_order_payloads()
+
+    def get_magento_order_pages(self):
+        """
+        Generator which yields the summaries of the orders to import from
+        magento, one page at a time. The next page is fetched only when the
+        previous page has been consumed.
+
+        Pages are fetched using `get_magento_order_pages_by_number` or
+        `get_magento_order_pages_by_keyset` depending on the order pagination
+        of the channel.
+        """
+        OrderState = Pool().get('sale.channel.order_state')
+
+        order_states = OrderState.search([
+            ('channel', '=', self.id),
+        ])
+        order_states_to_import_in = map(
+            lambda state: state.code, order_states
+        )
+
+        if not order_states_to_import_in:
+            self.raise_user_error("states_not_found")
+
+        # Filter orders with store_id and state using search()
+        filter = {
+            'store_id': {'=': self.magento_store_id},
+            'state': {'in': order_states_to_import_in},
+        }
+        if self.magento_order_pagination == 'keyset':
+            pages = self.get_magento_order_pages_by_keyset(filter)
+        else:
+            pages = self.get_magento_order_pages_by_number(filter)
+        for orders_summaries in pages:
+            yield orders_summaries
+
+    def get_magento_order_pages_by_number(self, filters):
+        """
+        Generator which yields the pages of orders updated since the last
+        import, using the page number. Once the last page has been consumed
+        `last_order_import_time` is advanced.
+
+        :param filters: Filters for the search on magento
+        """
+        filters = dict(filters)
+        if self.last_order_import_time:
+            last_order_import_time = \
+                self.last_order_import_time.replace(microsecond=0)
+            filters.update({
+                'updated_at': {
+                    'gteq': last_order_import_time.isoformat(' ')
+                },
+            })
+        import_time = datetime.utcnow()
+
+        page = 1
+        has_next = True
+        while has_next:
+            with self.get_magento_session(magento.Order) as order_api:
+                # XXX: Pagination is only available in
+                # magento extension >= 1.6.1
+                api_res = order_api.search(
+                    filters=filters, limit=ORDER_PAGE_SIZE, page=page
+                )
+            has_next = api_res['hasNext']
+            page += 1
+            yield api_res['items']
+
+        # The next import starts from the time this import started, so
+        # that orders updated while it was running are not missed
+        self.write([self], {'last_order_import_time': import_time})
+
+    def get_magento_order_pages_by_keyset(self, filters):
+        """
+        Generator which yields the pages of orders updated since the last
+        import, without page offsets. Each page is searched for with the
+        orders whose id is greater than the last id of the previous page,
+        which needs magento to list orders by id. A page whose orders are
+        not sorted by id raises an error.
+
+        Once the last page has been consumed, the next import is set to
+        start from the latest `updated_at` of the orders seen, as given by
+        magento, but no later than the time this import started less
+        `ORDER_UPDATE_OVERLAP`. Orders are not walked by `updated_at`, so an
+        order updated while the import runs may be on a page read already.
+        This is stored in `magento_last_order_updated_at`.
+
+        The last order id is stored with each page in
+        `magento_last_order_id`, so that an import which was stopped resumes
+        after the last committed page. When an import resumes, the time the
+        stopped import started is unknown and the next import starts from
+        the same time as this one.
+
+        :param filters: Filters for the search on magento
+        """
+        filters = dict(filters)
+        last_updated_at = self.magento_last_order_updated_at
+        if last_updated_at:
+            filters['updated_at'] = {'gteq': last_updated_at.isoformat(' ')}
+        last_order_id = self.magento_last_order_id or 0
+        resumed = bool(last_order_id)
+        import_time = datetime.utcnow().replace(microsecond=0) - \
+            ORDER_UPDATE_OVERLAP
+
+        while True:
+            filters['order_id'] = {'gt': last_order_id}
+            with self.get_magento_session(magento.Order) as order_api:
+                orders_summaries = order_api.search(
+                    filters=filters, limit=ORDER_PAGE_SIZE
+                )['items']
+            if not orders_summaries:
+                break
+
+            order_ids = [
+                int(order_summary['order_id'])
+                for order_summary in orders_summaries
+            ]
+            if order_ids != sorted(order_ids):
+                self.raise_user_error('orders_not_sorted_by_id')
+            last_order_id = order_ids[-1]
+            page_updated_at = max(
+                datetime.strptime(
+                    order_summary['updated_at'], '%Y-%m-%d %H:%M:%S'
+                ) for order_summary in orders_summaries
+            )
+            if not last_updated_at or page_updated_at > last_updated_at:
+                last_updated_at = page_updated_at
+            # Written before the page is imported, so that it is committed
+            # along with the orders of the page
+            self.write([self], {'magento_last_order_id': last_order_id})
+            yield orders_summaries
+
+            if len(orders_summaries) < ORDER_PAGE_SIZE:
+                break
+
+        if resumed:
+            last_updated_at = self.magento_last_order_updated_at
+        else:
+            last_updated_at = min(last_updated_at or import_time, import_time)
+        self.write([self], {
+            'magento_last_order_updated_at': last_updated_at,
+            'magento_last_order_id': None,
+        })
+
+    def import_orders_using_magento_data(self, orders_summaries):
+        """
+        Import the orders for the given order summaries. Orders which are
+        not imported yet are downloaded into order payloads using
+        `stage_magento_orders` and sales are then created from the payloads.
+
+        :param orders_summaries: List of order summaries from magento, which
+                                 must have the order_id and increment_id
+        :return: List of active record of sale imported
+        """
+        Sale = Pool().get('sale.sale')
+        Payload = Pool().get('magento.order.payload')
+
+        # Orders already imported are looked up all at once and skipped
+        # before anything is fetched from magento
+        existing_sales = Sale.find_all_using_magento_data(orders_summaries)
+
+        sales = []
+        new_orders_summaries = []
+        for order_summary in orders_summaries:
+            sale = existing_sales.get(int(order_summary['order_id']))
+            if sale:
+                sales.append(sale)
+            else:
+                new_orders_summaries.append(order_summary)
+
+        sales.extend(
+            Payload.process(self.stage_magento_orders(new_orders_summaries))
+        )
+        return sales
+
+    def stage_magento_orders(self, orders_summaries):
+        """
+        Download the data of the given orders from magento into order
+        payloads, in batches using `get_magento_orders_data`. The payload
+        of an order which was downloaded before is replaced and set back to
+        pending.
+
+        If magento raises a fault for an order, a channel exception is
+        logged for it and the other orders are still downloaded.
+
+        :param orders_summaries: List of order summaries from magento, which
+                                 must have the order_id and increment_id
+        :return: List of active record of order payloads, in the order of
+                 the summaries
+        """
+        Payload = Pool().get('magento.order.payload')
+        ChannelException = Pool().get('channel.exception')
+
+        increment_ids = [
+            order_summary['increment_id']
+            for order_summary in orders_summaries
+        ]
+        existing_payloads = {}
+        for sub_ids in grouped_slice(increment_ids):
+            for payload in Payload.search([
+                ('channel', '=', self.id),
+                ('increment_id', 'in', list(sub_ids)),
+            ]):
+                existing_payloads[payload.increment_id] = payload
+
+        payloads = []
+        for increment_id, order_data in self.get_magento_orders_data(
+            increment_ids
+        ):
+            if isinstance(order_data, xmlrpclib.Fault):
+                ChannelException.create([{
+                    'origin': '%s,%s' % (self.__name__, self.id),
+                    'log': "Error occurred on fetching order %s.\nError "
+                        "Message: %s" % (increment_id, order_data.faultString),
+                    'channel': self.id,
+                }])
+                continue
+
+            values = Payload.get_values_using_magento_data(order_data)
+            payload = existing_payloads.get(increment_id)
+            if payload:
+                Payload.write([payload], values)
+            else:
+                values['channel'] = self.id
+                payload, = Payload.create([values])
+            payloads.append(payload)
+
+        return payloads
+
+    def get_magento_orders_data(self, increment_ids):
+        """
+        Fetch the data of the given orders from magento. Instead of a
+        request per order, the `sales_order.info` calls are grouped in
+        multiCall requests of `magento_multicall_batch_size` orders.
+
+        If `magento_order_fetch_concurrency` is more than one, that many
+        requests are sent at a time from a pool of threads, each with its
+        own magento session. The data is still returned in the order of the
+        increment ids, and the data of the first batches can be used while
+        the next batches are being downloaded.
+
+        :param increment_ids: List of increment ids of orders
+        :return: Iterator over (increment_id, order_data) tuples. If magento
+                 raised a fault for an order, the `xmlrpclib.Fault` is given
+                 in place of its data.
+        """
+        return izip(increment_ids, self.get_magento_data(
+            magento.Order, [
+                ['sales_order.info', [increment_id]]
+                for increment_id in increment_ids
+            ], self.magento_order_fetch_concurrency
+        ))
+
+    def get_magento_data(self, api_class, calls, concurrency=1):
+        """
+        Send the given calls to magento in multiCall requests of
+        `magento_multicall_batch_size` calls.
+
+        If `concurrency` is more than one, that many requests are sent at a
+        time from a pool of threads, each with its own magento session. The
+        results are still returned in the order of the calls, and the
+        results of the first requests can be used while the next ones are
+        being sent.
+
+        :param api_class: Magento API class, eg: `magento.Order`
+        :param calls: List of [<resource path>, <arguments>] calls
+        :param concurrency: Number of requests sent at a time
+        :return: Iterator over the results in the order of the calls. If
+                 magento raised a fault for a call, the `xmlrpclib.Fault` is
+                 given in place of its result.
+        """
+        if not calls:
+            return iter([])
+
+        batch_size = self.magento_multicall_batch_size
+        if (concurrency or 1) <= 1:
+            with self.get_magento_session(api_class) as api:
+                return iter(list(multicall(api, calls, batch_size)))
+
+        # The worker threads cannot read the channel as the transaction
+        # belongs to this thread
+        session_args = (
+            api_class, self.magento_url, self.magento_api_user,
+            self.magento_api_key
+        )
+
+        def send(batch):
+            with session_pool.session(*session_args) as api:
+                return list(multicall(api, batch, batch_size))
+
+        batches = [
+            calls[index:index + batch_size]
+            for index in xrange(0, len(calls), batch_size)
+        ]
+        return chain.from_iterable(threaded_imap(send, batches, concurrency))
+
     def import_order(self, order_info):
         "Downstream implementation to import sale order from magento"
         if self.source != 'magento':
@@ -402,9 +1050,7 @@ class Channel:
             return sale
 
         with Transaction().set_context({'current_channel': self.id}):
-            with magento.Order(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as order_api:
+            with self.get_magento_session(magento.Order) as order_api:
                 order_data = order_api.info(order_info['increment_id'])
                 return Sale.create_using_magento_data(order_data)
 
@@ -504,9 +1150,8 @@ class Channel:
                             shipment.magento_increment_id:
                         sales.pop(sale)
                         continue
-                    with magento.Shipment(
-                        self.magento_url, self.magento_api_user,
-                        self.magento_api_key
+                    with self.get_magento_session(
+                        magento.Shipment
                     ) as shipment_api:
                         item_qty_map = {}
                         for move in shipment.outgoing_moves:
@@ -559,60 +1204,157 @@ class Channel:
         """
         Exports stock data of products from tryton to magento for this
         channel
-        :return: List of product templates
-        """
-        Location = Pool().get('stock.location')
 
-        self.validate_magento_channel()
+        The quantities of all the listed products are computed at once and
+        only the listings whose quantity or stock availability changed since
+        their last export are sent, over a single session and
+        `magento_multicall_batch_size` updates in each request. A product
+        whose update fails is logged as a channel exception without stopping
+        the export of the others, and is sent again by the next export.
 
-        products = []
-        locations = Location.search([('type', '=', 'storage')])
+        :return: List of products whose stock was sent
+        """
+        ChannelListing = Pool().get('product.product.channel_listing')
+        ChannelException = Pool().get('channel.exception')
 
-        for listing in self.product_listings:
-            product = listing.product
-            products.append(product)
+        self.validate_magento_channel()
 
-            with Transaction().set_context({'locations': map(int, locations)}):
-                product_data = {
-                    'qty': product.quantity,
-                    'is_in_stock': '1' if listing.product.quantity > 0
-                        else '0',
+        listings = list(self.product_listings)
+        quantities = self.get_magento_stock_quantities(
+            [listing.product for listing in listings]
+        )
+
+        changed_listings = []
+        calls = []
+        for listing in listings:
+            quantity = quantities[listing.product.id]
+            in_stock = quantity > 0
+            if listing.magento_exported_quantity == quantity and \
+                    listing.magento_exported_in_stock == in_stock:
+                continue
+            changed_listings.append(listing)
+            calls.append(['cataloginventory_stock_item.update', [
+                listing.product_identifier, {
+                    'qty': quantity,
+                    'is_in_stock': '1' if in_stock else '0',
                 }
+            ]])
+
+        if not calls:
+            return []
+
+        exported_listings = []
+        with self.get_magento_session(magento.Inventory) as inventory_api:
+            for listing, result in izip(changed_listings, multicall(
+                inventory_api, calls, self.magento_multicall_batch_size
+            )):
+                if isinstance(result, xmlrpclib.Fault):
+                    ChannelException.create([{
+                        'origin': '%s,%s' % (self.__name__, self.id),
+                        'log': (
+                            "Error occurred on exporting inventory of "
+                            "product %s.\nError Message: %s" % (
+                                listing.product_identifier, result.faultString
+                            )
+                        ),
+                        'channel': self.id,
+                    }])
+                    continue
+                exported_listings.append(listing)
+
+        to_write = []
+        for listing in exported_listings:
+            quantity = quantities[listing.product.id]
+            to_write.extend(([listing], {
+                'magento_exported_quantity': quantity,
+                'magento_exported_in_stock': quantity > 0,
+            }))
+        if to_write:
+            ChannelListing.write(*to_write)
+
+        return [listing.product for listing in exported_listings]
+
+    def get_magento_stock_quantities(self, products):
+        """
+        Returns the quantities in stock of the given products in the storage
+        locations, computed for all the products with a single
+        `products_by_location` call.
 
-                # Update stock information to magento
-                with magento.Inventory(
-                    self.magento_url, self.magento_api_user,
-                    self.magento_api_key
-                ) as inventory_api:
-                    inventory_api.update(
-                        listing.product_identifier, product_data
-                    )
+        A storage location inside another storage location is counted
+        once, as part of the outermost one.
 
-        return products
+        :param products: List of active records of products
+        :return: Dictionary of product id and quantity
+        """
+        Location = Pool().get('stock.location')
+        Product = Pool().get('product.product')
+
+        locations = Location.search([('type', '=', 'storage')])
+        storage_ids = set(map(int, locations))
+        location_ids = set()
+        for location in locations:
+            parent = location.parent
+            while parent and parent.id not in storage_ids:
+                parent = parent.parent
+            if not parent:
+                location_ids.add(location.id)
+
+        quantities = dict.fromkeys(map(int, products), 0.0)
+        if not quantities or not location_ids:
+            return quantities
+
+        with Transaction().set_context(Product._quantity_context('quantity')):
+            quantities_by_location = Product.products_by_location(
+                list(location_ids), product_ids=quantities.keys(),
+                with_childs=True
+            )
+        for (location_id, product_id), quantity in \
+                quantities_by_location.iteritems():
+            if product_id in quantities:
+                quantities[product_id] += quantity
+        return quantities
 
     def export_product_prices(self):
         """
         Exports tier prices of products from tryton to magento for this channel
-        :return: List of products
+
+        The tier prices are computed for the listings which may have changed
+        since `last_product_price_export_time`: listings whose product,
+        template, price tiers or themselves were changed, and listings
+        whose tier prices were never sent. The tier prices of all the
+        listings are computed if the price list or the default price tiers
+        changed, see `price_rules_changed_since`.
+
+        Only the tier prices which changed since their last export are sent,
+        over a single session and `magento_multicall_batch_size` updates in
+        each request. A listing whose update fails is logged as a channel
+        exception and is sent again by the next export.
+
+        :return: Number of listings whose tier prices were sent
         """
         if self.source != 'magento':
             return super(Channel, self).export_product_prices()
 
         ChannelListing = Pool().get('product.product.channel_listing')
+        ChannelException = Pool().get('channel.exception')
 
         price_domain = [
             ('channel', '=', self.id),
         ]
-
-        if self.last_product_price_export_time:
+        # Dates of records are stored to the second
+        last_export_time = self.last_product_price_export_time and \
+            self.last_product_price_export_time.replace(microsecond=0)
+        if last_export_time and \
+                not self.price_rules_changed_since(last_export_time):
             price_domain.append([
-                'OR', [(
-                    'product.write_date', '>=',
-                    self.last_product_price_export_time
-                )], [(
-                    'product.template.write_date', '>=',
-                    self.last_product_price_export_time
-                )]
+                'OR',
+                ('magento_tier_price_hash', '=', None),
+                ('create_date', '>=', last_export_time),
+                ('write_date', '>=', last_export_time),
+                ('product.write_date', '>=', last_export_time),
+                ('product.template.write_date', '>=', last_export_time),
+                ('price_tiers.create_date', '>=', last_export_time),
+                ('price_tiers.write_date', '>=', last_export_time),
             ])
 
         product_listings = ChannelListing.search(price_domain)
@@ -620,43 +1362,150 @@ class Channel:
         self.last_product_price_export_time = datetime.utcnow()
         self.save()
 
-        for listing in product_listings:
-
-            # Get the price tiers from the product listing if the list has
-            # price tiers else get the default price tiers from current
-            # channel
-            price_tiers = listing.price_tiers or self.magento_price_tiers
-
-            price_data = []
-            for tier in price_tiers:
-                if hasattr(tier, 'product_listing'):
-                    # The price tier comes from a product listing, then it has a
-                    # function field for price, we use it directly
-                    price = tier.price
-                else:
-                    # The price tier comes from the default tiers on
-                    # channel,
-                    # we dont have a product on tier, so we use the current
-                    # product in loop for computing the price for this tier
-                    price = self.price_list.compute(
-                        None, listing.product, listing.product.list_price,
-                        tier.quantity, self.default_uom
-                    )
-
-                price_data.append({
-                    'qty': tier.quantity,
-                    'price': float(price),
-                })
-
-            # Update stock information to magento
-            with magento.ProductTierPrice(
-                self.magento_url, self.magento_api_user, self.magento_api_key
-            ) as tier_price_api:
-                tier_price_api.update(
-                    listing.product_identifier, price_data
+        # The price tiers of a listing, or the default price tiers of the
+        # channel if it has none, are computed at once for all the listings
+        default_quantities = [
+            tier.quantity for tier in self.magento_price_tiers
+        ]
+        listing_quantities = [
+            (
+                listing,
+                [tier.quantity for tier in listing.price_tiers] or
+                default_quantities
+            ) for listing in product_listings
+        ]
+        prices = self.get_magento_prices([
+            (listing.product, quantity)
+            for listing, quantities in listing_quantities
+            for quantity in quantities
+        ])
+
+        changed_listings = []
+        calls = []
+        for listing, quantities in listing_quantities:
+            price_data = [{
+                'qty': quantity,
+                'price': float(prices[(listing.product.id, quantity)]),
+            } for quantity in quantities]
+
+            price_hash = hashlib.sha1(
+                json.dumps(price_data, sort_keys=True)
+            ).hexdigest()
+            if listing.magento_tier_price_hash == price_hash:
+                continue
+            changed_listings.append((listing, price_hash))
+            calls.append([
+                'catalog_product_attribute_tier_price.update',
+                [listing.product_identifier, price_data, None]
+            ])
+
+        if not calls:
+            return 0
+
+        to_write = []
+        failed_listings = []
+        with self.get_magento_session(
+            magento.ProductTierPrice
+        ) as tier_price_api:
+            for (listing, price_hash), result in izip(
+                changed_listings, multicall(
+                    tier_price_api, calls, self.magento_multicall_batch_size
                 )
+            ):
+                if isinstance(result, xmlrpclib.Fault):
+                    ChannelException.create([{
+                        'origin': '%s,%s' % (self.__name__, self.id),
+                        'log': (
+                            "Error occurred on exporting tier prices of "
+                            "product %s.\nError Message: %s" % (
+                                listing.product_identifier, result.faultString
+                            )
+                        ),
+                        'channel': self.id,
+                    }])
+                    failed_listings.append(listing)
+                    continue
+                to_write.extend((
+                    [listing], {'magento_tier_price_hash': price_hash}
+                ))
+
+        if to_write:
+            ChannelListing.write(*to_write)
+        if failed_listings:
+            # Computed again by the next export
+            ChannelListing.write(failed_listings, {
+                'magento_tier_price_hash': None,
+            })
+
+        return len(to_write) // 2
+
+    def price_rules_changed_since(self, since):
+        """
+        Check if the price list of the channel, its lines or the default
+        price tiers of the channel were created or changed since the given
+        time. Changing the price list, default uom or default price tiers
+        of the channel itself resets `last_product_price_export_time`.
+
+        :param since: Datetime
+        :return: True if the prices of any listing may have changed
+        """
+        PriceList = Pool().get('product.price_list')
+        MagentoTier = Pool().get('sale.channel.magento.price_tier')
+
+        return bool(PriceList.search([
+            ('id', '=', self.price_list.id),
+            [
+                'OR',
+                ('write_date', '>=', since),
+                ('lines.create_date', '>=', since),
+                ('lines.write_date', '>=', since),
+            ],
+        ], count=True) or MagentoTier.search([
+            ('channel', '=', self.id),
+            [
+                'OR',
+                ('create_date', '>=', since),
+                ('write_date', '>=', since),
+            ],
+        ], count=True))
 
-        return len(product_listings)
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        args = []
+        for channels, values in zip(actions, actions):
+            if set(values) & set(PRICE_RULE_FIELDS):
+                # The tier prices of all the listings are computed again
+                values = values.copy()
+                values['last_product_price_export_time'] = None
+            args.extend((channels, values))
+        super(Channel, cls).write(*args)
+
+    def get_magento_prices(self, product_quantities):
+        """
+        Returns the prices of the price list of the channel for the given
+        pairs of product and quantity, in the default uom of the channel.
+        Each price is computed with `compute` of the price list, once for
+        each distinct pair, so that modules overriding the price list give
+        the same prices on magento as in tryton. The pairs are not batched
+        any further, callers only ask for the prices which may have changed,
+        see `export_product_prices`.
+
+        :param product_quantities: List of pairs of active record of product
+                                   and quantity
+        :return: Dictionary of (product id, quantity) and price
+        """
+        price_list = self.price_list
+
+        prices = {}
+        for product, quantity in product_quantities:
+            key = (product.id, quantity)
+            if key not in prices:
+                prices[key] = price_list.compute(
+                    None, product, product.list_price, quantity,
+                    self.default_uom
+                )
+        return prices
 
     def get_tryton_action(self, name):
         """
@@ -730,3 +1579,31 @@ class MagentoTier(ModelSQL, ModelView):
                 'Quantity in price tiers must be unique for a channel'
             )
         ]
+
+    @classmethod
+    def delete(cls, tiers):
+        Channel = Pool().get('sale.channel')
+
+        # The tier prices of all the listings are computed again
+        Channel.write(list(set(tier.channel for tier in tiers)), {
+            'last_product_price_export_time': None,
+        })
+        super(MagentoTier, cls).delete(tiers)
+
+
+class ChannelException:
+    """
+    Channel Exception
+    """
+    __name__ = 'channel.exception'
+
+    @classmethod
+    def models_get(cls):
+        """
+        Allow exceptions to be logged on the channel itself, for errors
+        which happen before a sale is created, like an order that could
+        not be fetched from magento
+        """
+        res = super(ChannelException, cls).models_get()
+        res.append(('sale.channel', 'Sale Channel'))
+        return res
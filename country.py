@@ -8,6 +8,8 @@
     :license: BSD, see LICENSE for more details.
 """
 from trytond.pool import PoolMeta
+from trytond.transaction import Transaction
+from trytond.cache import Cache
 
 
 __all__ = ['Country', 'Subdivision']
@@ -18,6 +20,10 @@ class Country:
     "Country"
     __name__ = 'country.country'
 
+    _magento_code_cache = Cache(
+        'country.country.search_using_magento_code', context=False
+    )
+
     @classmethod
     def __setup__(cls):
         """
@@ -36,6 +42,10 @@ class Country:
         :param code: ISO code of country
         :return: Browse record of country if found else raises error
         """
+        country_id = cls._magento_code_cache.get(code)
+        if country_id is not None:
+            return cls(country_id)
+
         countries = cls.search([('code', '=', code)])
 
         if not countries:
@@ -43,30 +53,88 @@ class Country:
                 "country_not_found", error_args=(code, )
             )
 
+        cls._magento_code_cache.set(code, countries[0].id)
         return countries[0]
 
+    @classmethod
+    def create(cls, vlist):
+        cls._magento_code_cache.clear()
+        return super(Country, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._magento_code_cache.clear()
+        super(Country, cls).write(*args)
+
+    @classmethod
+    def delete(cls, countries):
+        cls._magento_code_cache.clear()
+        super(Country, cls).delete(countries)
+
 
 class Subdivision:
     "Subdivision"
     __name__ = 'country.subdivision'
 
+    _magento_region_cache = Cache(
+        'country.subdivision.search_using_magento_region', context=False
+    )
+
     @classmethod
     def search_using_magento_region(cls, region, country):
         """
         Searches for state with given magento region.
         Magento does not send state code but it just sends region name
         thats why subdivisions here are searched using a case insensitive
-        search
+        match of their name, see `get_magento_region_map`
 
         :param region: Name of state from magento
         :param country: Active record of country
-        :return: Active record of state if found else raises error
+        :return: Active record of state if found else None
         """
-        subdivisions = cls.search([
-            ('name', 'ilike', region),
-            ('country', '=', country.id),
-        ])
-
         # TODO: Exception need be created if subdivison does not exist.
+        subdivision_id = cls.get_magento_region_map(country).get(
+            region.lower()
+        )
+        return subdivision_id and cls(subdivision_id) or None
+
+    @classmethod
+    def get_magento_region_map(cls, country):
+        """
+        Returns a dictionary of the lower cased names of the subdivisions
+        of the country and their ID. If several subdivisions have the same
+        name, the first in the order of subdivisions is kept.
+
+        The map of a country is built with a single search and cached until
+        subdivisions change. Names are translated, so the map is kept for
+        each language.
+
+        :param country: Active record of country
+        :return: Dictionary of lower cased name and subdivision ID
+        """
+        key = (country.id, Transaction().language)
+        region_map = cls._magento_region_cache.get(key)
+        if region_map is not None:
+            return region_map
+
+        region_map = {}
+        for subdivision in cls.search([('country', '=', country.id)]):
+            region_map.setdefault(subdivision.name.lower(), subdivision.id)
 
-        return subdivisions and subdivisions[0] or None
+        cls._magento_region_cache.set(key, region_map)
+        return region_map
+
+    @classmethod
+    def create(cls, vlist):
+        cls._magento_region_cache.clear()
+        return super(Subdivision, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._magento_region_cache.clear()
+        super(Subdivision, cls).write(*args)
+
+    @classmethod
+    def delete(cls, subdivisions):
+        cls._magento_region_cache.clear()
+        super(Subdivision, cls).delete(subdivisions)
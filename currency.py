@@ -8,6 +8,7 @@
     :license: BSD, see LICENSE for more details.
 """
 from trytond.pool import PoolMeta
+from trytond.cache import Cache
 
 
 __all__ = ['Currency']
@@ -18,6 +19,10 @@ class Currency:
     "Currency"
     __name__ = 'currency.currency'
 
+    _magento_code_cache = Cache(
+        'currency.currency.search_using_magento_code', context=False
+    )
+
     @classmethod
     def __setup__(cls):
         """
@@ -36,9 +41,29 @@ class Currency:
         :param currency_code: currency code given by magento
         :return: Active record of currency if found else raises error
         """
+        currency_id = cls._magento_code_cache.get(currency_code)
+        if currency_id is not None:
+            return cls(currency_id)
+
         currencies = cls.search([('code', '=', currency_code)])
 
         if not currencies:
             return cls.raise_user_error('currency_not_found', (currency_code, ))
 
+        cls._magento_code_cache.set(currency_code, currencies[0].id)
         return currencies[0]
+
+    @classmethod
+    def create(cls, vlist):
+        cls._magento_code_cache.clear()
+        return super(Currency, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        cls._magento_code_cache.clear()
+        super(Currency, cls).write(*args)
+
+    @classmethod
+    def delete(cls, currencies):
+        cls._magento_code_cache.clear()
+        super(Currency, cls).delete(currencies)
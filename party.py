@@ -8,15 +8,37 @@
     :license: BSD, see LICENSE for more details.
 """
 import magento
+import hashlib
+from collections import OrderedDict
+
+from sql import Null
 
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.pool import PoolMeta, Pool
 from trytond.transaction import Transaction
+from trytond.cache import LRUDict
+from trytond.tools import grouped_slice
 
 
 __all__ = ['Party', 'MagentoWebsiteParty', 'Address']
 __metaclass__ = PoolMeta
 
+#: Maximum number of customers kept in the identity map of a transaction
+PARTY_IDENTITY_MAP_SIZE = 10000
+
+#: Fields of the addresses compared to match the addresses sent by magento
+MAGENTO_FINGERPRINT_FIELDS = (
+    'name', 'street', 'zip', 'city', 'country', 'subdivision'
+)
+
+
+def normalize_email(email):
+    """
+    Returns the email in the form used to compare the emails of guests, or
+    None if there is no email
+    """
+    return email and email.strip().lower() or None
+
 
 class Party:
     "Party"
@@ -52,15 +74,29 @@ class Party:
 
         party = cls.find_using_magento_id(magento_id)
         if not party:
-            with magento.Customer(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as customer_api:
+            with channel.get_magento_session(magento.Customer) as customer_api:
                 customer_data = customer_api.info(magento_id)
 
             party = cls.create_using_magento_data(customer_data)
         return party
 
+    @staticmethod
+    def get_magento_identity_map():
+        """
+        Returns the identity map of the customers of magento, a dictionary
+        of (channel id, magento customer id) and party id. Repeat customers
+        are found in it without any query.
+
+        The map is kept in the cache of the transaction cursor, which is
+        cleared on commit and rollback, so it never holds a party which does
+        not exist. Its size is bounded by `PARTY_IDENTITY_MAP_SIZE`, the
+        least recently used customers being dropped first.
+        """
+        return Transaction().cursor.get_cache().setdefault(
+            '_magento_party_identity_map',
+            LRUDict(PARTY_IDENTITY_MAP_SIZE)
+        )
+
     @classmethod
     def find_using_magento_id(cls, magento_id):
         """
@@ -71,16 +107,92 @@ class Party:
         """
         MagentoParty = Pool().get('sale.channel.magento.party')
 
+        channel_id = Transaction().context['current_channel']
+        identity_map = cls.get_magento_identity_map()
+        key = (channel_id, int(magento_id))
+        if key in identity_map:
+            return cls(identity_map[key])
+
         try:
             magento_party, = MagentoParty.search([
                 ('magento_id', '=', magento_id),
-                ('channel', '=', Transaction().context['current_channel'])
+                ('channel', '=', channel_id)
             ])
         except ValueError:
             return None
         else:
+            if magento_party.magento_id:
+                identity_map[key] = magento_party.party.id
             return magento_party.party
 
+    @classmethod
+    def find_all_using_magento_ids(cls, magento_ids):
+        """
+        Finds the parties of all the given magento customer IDs with a query
+        per slice of IDs, and adds them to the identity map so that the
+        orders of these customers find their party without any query.
+
+        :param magento_ids: List of customer IDs sent by magento
+        :return: Dictionary of the parties found with their magento ID as key
+        """
+        MagentoParty = Pool().get('sale.channel.magento.party')
+
+        channel_id = Transaction().context['current_channel']
+        identity_map = cls.get_magento_identity_map()
+
+        parties = {}
+        magento_ids = set(map(int, magento_ids)) - set([0])
+        for sub_ids in grouped_slice(list(magento_ids)):
+            for magento_party in MagentoParty.search([
+                ('magento_id', 'in', list(sub_ids)),
+                ('channel', '=', channel_id),
+            ]):
+                parties[magento_party.magento_id] = magento_party.party
+                identity_map[(channel_id, magento_party.magento_id)] = \
+                    magento_party.party.id
+        return parties
+
+    @classmethod
+    def find_or_create_all_using_magento_ids(cls, magento_ids):
+        """
+        Finds the parties of all the given magento customer IDs like
+        `find_all_using_magento_ids`, then fetches the customers which are
+        not found with a `customer.list` call per slice of IDs and creates
+        their parties at once with `create_all_using_magento_data`.
+
+        Customers which magento does not list are left out of the result.
+
+        :param magento_ids: List of customer IDs sent by magento
+        :return: Dictionary of the parties found or created with their
+                 magento ID as key
+        """
+        Channel = Pool().get('sale.channel')
+
+        parties = cls.find_all_using_magento_ids(magento_ids)
+        missing_ids = set(map(int, magento_ids)) - set(parties) - set([0])
+        if not missing_ids:
+            return parties
+
+        channel = Channel.get_current_magento_channel()
+        customers_data = []
+        with channel.get_magento_session(magento.Customer) as customer_api:
+            for sub_ids in grouped_slice(sorted(missing_ids)):
+                # magento maps the customer_id filter to the entity_id
+                customers_data.extend(customer_api.list({
+                    'customer_id': {'in': list(sub_ids)},
+                }))
+
+        # Customers merged on magento may be listed more than once
+        customers_data = dict(
+            (int(data['customer_id']), data) for data in customers_data
+            if int(data['customer_id']) in missing_ids
+        ).values()
+        parties.update(zip(
+            [int(data['customer_id']) for data in customers_data],
+            cls.create_all_using_magento_data(customers_data)
+        ))
+        return parties
+
     @classmethod
     def find_or_create_using_magento_data(cls, magento_data):
         """
@@ -103,14 +215,14 @@ class Party:
         return party
 
     @classmethod
-    def create_using_magento_data(cls, magento_data):
+    def get_party_values_using_magento_data(cls, magento_data):
         """
-        Creates record of customer values sent by magento
+        Returns the values to create the party of the customer
 
         :param magento_data: Dictionary of values for customer sent by magento
-        :return: Active record of record created
+        :return: Dictionary of values of the party
         """
-        party, = cls.create([{
+        return {
             'name': u' '.join(
                 [magento_data['firstname'], magento_data['lastname']]
             ),
@@ -118,6 +230,8 @@ class Party:
                 ('create', [{
                     'magento_id': magento_data['customer_id'],
                     'channel': Transaction().context['current_channel'],
+                    'guest_email': None if int(magento_data['customer_id'])
+                        else normalize_email(magento_data['email']),
                 }])
             ],
             'contact_mechanisms': [
@@ -126,10 +240,135 @@ class Party:
                     'value': magento_data['email'],
                 }])
             ]
-        }])
+        }
 
+    @classmethod
+    def create_using_magento_data(cls, magento_data):
+        """
+        Creates record of customer values sent by magento
+
+        :param magento_data: Dictionary of values for customer sent by magento
+        :return: Active record of record created
+        """
+        party, = cls.create_all_using_magento_data([magento_data])
         return party
 
+    @classmethod
+    def create_all_using_magento_data(cls, customers_data):
+        """
+        Creates the parties of all the customers sent by magento at once and
+        adds them to the identity map
+
+        :param customers_data: List of dictionaries of values for customers
+                               sent by magento
+        :return: List of active records created, in the order of the data
+        """
+        channel_id = Transaction().context['current_channel']
+        parties = cls.create([
+            cls.get_party_values_using_magento_data(magento_data)
+            for magento_data in customers_data
+        ])
+
+        identity_map = cls.get_magento_identity_map()
+        for magento_data, party in zip(customers_data, parties):
+            # Guests have no customer ID and are kept by their email
+            if int(magento_data['customer_id']):
+                identity_map[
+                    (channel_id, int(magento_data['customer_id']))
+                ] = party.id
+            elif normalize_email(magento_data['email']):
+                identity_map.setdefault(
+                    (channel_id, normalize_email(magento_data['email'])),
+                    party.id
+                )
+
+        return parties
+
+    @classmethod
+    def find_all_guests_using_magento_emails(cls, emails):
+        """
+        Finds the guest parties of the channel in context with the given
+        emails, compared once normalized. If several guest parties have the
+        same email, the oldest is found.
+
+        :param emails: List of emails of guests sent by magento
+        :return: Dictionary of the parties found with their normalized email
+                 as key
+        """
+        MagentoParty = Pool().get('sale.channel.magento.party')
+
+        channel_id = Transaction().context['current_channel']
+        identity_map = cls.get_magento_identity_map()
+
+        parties = {}
+        missing_emails = set()
+        for email in filter(None, map(normalize_email, emails)):
+            if (channel_id, email) in identity_map:
+                parties[email] = cls(identity_map[(channel_id, email)])
+            else:
+                missing_emails.add(email)
+
+        for sub_emails in grouped_slice(list(missing_emails)):
+            for magento_party in MagentoParty.search([
+                ('magento_id', '=', 0),
+                ('channel', '=', channel_id),
+                ('guest_email', 'in', list(sub_emails)),
+            ], order=[('id', 'ASC')]):
+                if magento_party.guest_email in parties:
+                    continue
+                parties[magento_party.guest_email] = magento_party.party
+                identity_map[(channel_id, magento_party.guest_email)] = \
+                    magento_party.party.id
+        return parties
+
+    @classmethod
+    def find_or_create_all_guests_using_magento_data(cls, guests_data):
+        """
+        Finds the guest parties of all the given guests by their email like
+        `find_all_guests_using_magento_emails`, and creates the parties of
+        the guests not found at once, one for each email.
+
+        Guests without email are left out, a new party is created for each
+        of their orders.
+
+        :param guests_data: List of dictionaries of values for guests sent
+                            by magento, with a customer_id of 0
+        :return: Dictionary of the parties found or created with their
+                 normalized email as key
+        """
+        parties = cls.find_all_guests_using_magento_emails([
+            guest_data['email'] for guest_data in guests_data
+        ])
+
+        missing_guests = OrderedDict()
+        for guest_data in guests_data:
+            email = normalize_email(guest_data['email'])
+            if email and email not in parties:
+                missing_guests.setdefault(email, guest_data)
+
+        parties.update(zip(
+            missing_guests.keys(),
+            cls.create_all_using_magento_data(missing_guests.values())
+        ))
+        return parties
+
+    @classmethod
+    def find_or_create_guest_using_magento_data(cls, guest_data):
+        """
+        Finds the guest party of the channel in context with the email of
+        the guest, or creates it
+
+        :param guest_data: Dictionary of values for guest sent by magento,
+                           with a customer_id of 0
+        :return: Active record of record created/found
+        """
+        email = normalize_email(guest_data['email'])
+        if not email:
+            return cls.create_using_magento_data(guest_data)
+        return cls.find_or_create_all_guests_using_magento_data(
+            [guest_data]
+        )[email]
+
     @classmethod
     def find_using_magento_data(cls, magento_data):
         """
@@ -140,17 +379,7 @@ class Party:
         :param magento_data: Dictionary of values for customer sent by magento
         :return: Active record of record found or None
         """
-        MagentoParty = Pool().get('sale.channel.magento.party')
-
-        try:
-            magento_party, = MagentoParty.search([
-                ('magento_id', '=', magento_data['customer_id']),
-                ('channel', '=', Transaction().context['current_channel'])
-            ])
-        except ValueError:
-            return None
-        else:
-            return magento_party.party
+        return cls.find_using_magento_id(magento_data['customer_id'])
 
 
 class MagentoWebsiteParty(ModelSQL, ModelView):
@@ -164,12 +393,65 @@ class MagentoWebsiteParty(ModelSQL, ModelView):
     party = fields.Many2One(
         'party.party', 'Party', required=True, readonly=True
     )
+    #: The normalized email of a guest, by which the orders of guests are
+    #: imported for the same party when merging guest customers
+    guest_email = fields.Char('Guest Email', readonly=True, select=True)
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(MagentoWebsiteParty, cls).__register__(module_name)
+
+        # Migration: fill the email of the guests imported before it was
+        # stored
+        cls.fill_guest_email()
+
+    @classmethod
+    def fill_guest_email(cls):
+        """
+        Store the normalized email of the guests which have none, from the
+        first email contact mechanism of their party, directly in the table
+        """
+        ContactMechanism = Pool().get('party.contact_mechanism')
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+        contact_mechanism = ContactMechanism.__table__()
+
+        cursor.execute(*sql_table.join(
+            contact_mechanism,
+            condition=contact_mechanism.party == sql_table.party
+        ).select(
+            sql_table.id, contact_mechanism.value,
+            where=(sql_table.magento_id == 0) &
+            (sql_table.guest_email == Null) &
+            (contact_mechanism.type == 'email'),
+            order_by=[sql_table.id, contact_mechanism.id]
+        ))
+        guest_emails = OrderedDict()
+        for magento_party_id, email in cursor.fetchall():
+            guest_emails.setdefault(magento_party_id, normalize_email(email))
+
+        for magento_party_id, email in guest_emails.iteritems():
+            if email:
+                cursor.execute(*sql_table.update(
+                    [sql_table.guest_email], [email],
+                    where=sql_table.id == magento_party_id
+                ))
 
     @classmethod
     def validate(cls, records):
         super(MagentoWebsiteParty, cls).validate(records)
         cls.check_unique_party(records)
 
+    @classmethod
+    def write(cls, *args):
+        Pool().get('party.party').get_magento_identity_map().clear()
+        super(MagentoWebsiteParty, cls).write(*args)
+
+    @classmethod
+    def delete(cls, records):
+        Pool().get('party.party').get_magento_identity_map().clear()
+        super(MagentoWebsiteParty, cls).delete(records)
+
     @classmethod
     def __setup__(cls):
         """
@@ -201,46 +483,55 @@ class Address:
     "Address"
     __name__ = 'party.address'
 
+    #: Digest of the fields compared to match the addresses sent by magento
+    magento_fingerprint = fields.Char(
+        'Magento Fingerprint', readonly=True, select=True
+    )
+
+    @classmethod
+    def __register__(cls, module_name):
+        super(Address, cls).__register__(module_name)
+
+        # Migration: fill the fingerprint of the addresses created before
+        # it existed
+        cls.fill_magento_fingerprint()
+
+    @classmethod
+    def fill_magento_fingerprint(cls):
+        """
+        Store the fingerprint of the addresses which have none, directly in
+        the table
+        """
+        cursor = Transaction().cursor
+        sql_table = cls.__table__()
+
+        cursor.execute(*sql_table.select(
+            sql_table.id, sql_table.name, sql_table.street, sql_table.zip,
+            sql_table.city, sql_table.country, sql_table.subdivision,
+            where=sql_table.magento_fingerprint == Null
+        ))
+        for row in cursor.fetchall():
+            fingerprint = cls.get_magento_fingerprint(
+                dict(zip(MAGENTO_FINGERPRINT_FIELDS, row[1:]))
+            )
+            cursor.execute(*sql_table.update(
+                [sql_table.magento_fingerprint], [fingerprint],
+                where=sql_table.id == row[0]
+            ))
+
     def match_with_magento_data(self, address_data):
         """
         Match the current address with the address_record.
-        Match all the fields of the address, i.e., streets, city, subdivision
-        and country. For any deviation in any field, returns False.
+        Match all the fields of the address, i.e., name, streets, zip, city,
+        subdivision and country, the same way addresses are found by their
+        fingerprint. For any deviation in any field, returns False.
 
         :param address_data: Dictionary of address data from magento
         :return: True if address matches else False
         """
-        Country = Pool().get('country.country')
-        Subdivision = Pool().get('country.subdivision')
-
-        # Check if the name matches
-        if self.name != ' '.join(
-            [address_data['firstname'], address_data['lastname']]
-        ):
-            return False
-
-        # Find country and subdivision based on magento data
-        country = None
-        subdivision = None
-        if address_data['country_id']:
-            country = Country.search_using_magento_code(
-                address_data['country_id']
-            )
-            if address_data['region']:
-                subdivision = Subdivision.search_using_magento_region(
-                    address_data['region'], country
-                )
-
-        if not all([
-            self.street == (address_data['street'] or None),
-            self.zip == (address_data['postcode'] or None),
-            self.city == (address_data['city'] or None),
-            self.country == country,
-            self.subdivision == subdivision,
-        ]):
-            return False
-
-        return True
+        values = self.get_values_using_magento_data(address_data)
+        return self.compute_magento_fingerprint() == \
+            self.get_magento_fingerprint(values)
 
     @classmethod
     def find_or_create_for_party_using_magento_data(cls, party, address_data):
@@ -248,34 +539,36 @@ class Address:
         Look for the address in tryton corresponding to the address_record.
         If found, return the same else create a new one and return that.
 
+        The address is looked up by its fingerprint, see
+        `get_magento_fingerprint`, so a single indexed query is needed
+        whatever the number of addresses of the party.
+
         :param party: Party active record
         :param address_data: Dictionary of address data from magento
         :return: Active record of address created/found
         """
-        for address in party.addresses:
-            if address.match_with_magento_data(address_data):
-                break
-
-        else:
-            address = cls.create_for_party_using_magento_data(
-                party, address_data
-            )
+        addresses = cls.search([
+            ('party', '=', party.id),
+            ('magento_fingerprint', '=', cls.get_magento_fingerprint(
+                cls.get_values_using_magento_data(address_data)
+            )),
+        ], order=[('id', 'ASC')], limit=1)
+        if addresses:
+            return addresses[0]
 
-        return address
+        return cls.create_for_party_using_magento_data(party, address_data)
 
     @classmethod
-    def create_for_party_using_magento_data(cls, party, address_data):
+    def get_values_using_magento_data(cls, address_data):
         """
-        Create address from the address record given and link it to the
-        party.
+        Returns the values of the address fields compared to match an
+        address, from the address data of magento
 
-        :param party: Party active record
         :param address_data: Dictionary of address data from magento
-        :return: Active record of created address
+        :return: Dictionary of values of the address
         """
         Country = Pool().get('country.country')
         Subdivision = Pool().get('country.subdivision')
-        ContactMechanism = Pool().get('party.contact_mechanism')
 
         country = None
         subdivision = None
@@ -288,8 +581,7 @@ class Address:
                     address_data['region'], country
                 )
 
-        address, = cls.create([{
-            'party': party.id,
+        return {
             'name': ' '.join([
                 address_data['firstname'], address_data['lastname']
             ]),
@@ -298,7 +590,86 @@ class Address:
             'city': address_data['city'],
             'country': country and country.id or None,
             'subdivision': subdivision and subdivision.id or None,
-        }])
+        }
+
+    @staticmethod
+    def get_magento_fingerprint(values):
+        """
+        Returns the fingerprint of an address, a digest of its name, street,
+        zip, city, country and subdivision. The texts are compared case
+        insensitively and without the surrounding or repeated whitespace.
+
+        :param values: Dictionary of values of the address, with the IDs of
+                       the country and subdivision
+        :return: Hexadecimal digest
+        """
+        parts = []
+        for name in MAGENTO_FINGERPRINT_FIELDS:
+            value = values.get(name)
+            if isinstance(value, basestring):
+                value = u' '.join(value.split()).lower()
+            parts.append(unicode(value or u''))
+        return hashlib.sha1(u'\x1f'.join(parts).encode('utf-8')).hexdigest()
+
+    def compute_magento_fingerprint(self):
+        """
+        Returns the fingerprint of the current values of the address
+        """
+        return self.get_magento_fingerprint({
+            'name': self.name,
+            'street': self.street,
+            'zip': self.zip,
+            'city': self.city,
+            'country': self.country and self.country.id,
+            'subdivision': self.subdivision and self.subdivision.id,
+        })
+
+    @classmethod
+    def set_magento_fingerprint(cls, addresses):
+        """
+        Compute and store the fingerprint of the addresses
+        """
+        args = []
+        for address in cls.browse([a.id for a in addresses]):
+            fingerprint = address.compute_magento_fingerprint()
+            if fingerprint != address.magento_fingerprint:
+                args.extend(([address], {'magento_fingerprint': fingerprint}))
+        if args:
+            super(Address, cls).write(*args)
+
+    @classmethod
+    def create(cls, vlist):
+        vlist = [values.copy() for values in vlist]
+        for values in vlist:
+            values['magento_fingerprint'] = cls.get_magento_fingerprint(values)
+        return super(Address, cls).create(vlist)
+
+    @classmethod
+    def write(cls, *args):
+        super(Address, cls).write(*args)
+
+        addresses = []
+        actions = iter(args)
+        for records, values in zip(actions, actions):
+            if set(values) & set(MAGENTO_FINGERPRINT_FIELDS):
+                addresses.extend(records)
+        cls.set_magento_fingerprint(addresses)
+
+    @classmethod
+    def create_for_party_using_magento_data(cls, party, address_data):
+        """
+        Create address from the address record given and link it to the
+        party.
+
+        :param party: Party active record
+        :param address_data: Dictionary of address data from magento
+        :return: Active record of created address
+        """
+        ContactMechanism = Pool().get('party.contact_mechanism')
+
+        values = cls.get_values_using_magento_data(address_data)
+        values['party'] = party.id
+        address, = cls.create([values])
 
         # Create phone as contact mechanism
         if address_data.get('telephone') and not ContactMechanism.search([
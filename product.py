@@ -9,6 +9,7 @@ import magento
 from trytond.model import ModelSQL, ModelView, fields
 from trytond.transaction import Transaction
 from trytond.pool import PoolMeta, Pool
+from trytond.tools import grouped_slice
 from decimal import Decimal
 
 
@@ -85,10 +86,7 @@ class Category:
         if not category:
             channel = Channel.get_current_magento_channel()
 
-            with magento.Category(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as category_api:
+            with channel.get_magento_session(magento.Category) as category_api:
                 category_data = category_api.info(magento_id)
 
             category = cls.create_using_magento_data(
@@ -204,6 +202,18 @@ class ProductSaleChannelListing:
         ('virtual', 'Virtual'),
         ('downloadable', 'Downloadable'),
     ], 'Magento Product Type', readonly=True)
+    magento_exported_quantity = fields.Float(
+        'Exported Quantity', readonly=True,
+        help='Quantity last exported to magento'
+    )
+    magento_exported_in_stock = fields.Boolean(
+        'Exported In Stock', readonly=True,
+        help='Stock availability last exported to magento'
+    )
+    magento_tier_price_hash = fields.Char(
+        'Exported Tier Prices Hash', readonly=True,
+        help='Hash of the tier prices last exported to magento'
+    )
 
 
 class Product:
@@ -238,6 +248,21 @@ class Product:
 
         return products and products[0] or None
 
+    @classmethod
+    def find_all_using_magento_skus(cls, magento_skus):
+        """
+        Finds the products of all the given SKUs with a query per slice of
+        SKUs instead of a query per SKU
+
+        :param magento_skus: List of product SKUs from Magento
+        :returns: Dictionary of the products found with their SKU as key
+        """
+        products = {}
+        for sub_skus in grouped_slice(set(magento_skus)):
+            for product in cls.search([('code', 'in', list(sub_skus))]):
+                products.setdefault(product.code, product)
+        return products
+
     @classmethod
     def find_or_create_using_magento_data(cls, product_data):
         """
@@ -354,10 +379,7 @@ class Product:
 
         channel = Channel.get_current_magento_channel()
 
-        with magento.Product(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as product_api:
+        with channel.get_magento_session(magento.Product) as product_api:
             channel_listing, = SaleChannelListing.search([
                 ('product', '=', self.id),
                 ('channel', '=', channel.id),
@@ -451,10 +473,7 @@ class Product:
                 'missing_product_code', (self.name,)
             )
 
-        with magento.Product(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as product_api:
+        with channel.get_magento_session(magento.Product) as product_api:
             # We create only simple products on magento with the default
             # attribute set
             # TODO: We have to call the method from core API extension
@@ -512,19 +531,27 @@ class ProductPriceTier(ModelSQL, ModelView):
             )
         ]
 
-    def get_price(self, name):
-        """Calculate the price of the product for quantity set in record
+    @classmethod
+    def get_price(cls, tiers, name):
+        """Calculate the price of the product for quantity set in each
+        record, with the prices of all the records computed at once
 
+        :param tiers: List of active records of price tiers
         :param name: Name of field
+        :return: Dictionary of price tier id and price
         """
         Channel = Pool().get('sale.channel')
 
         if not Transaction().context.get('current_channel'):
-            return 0
+            return dict.fromkeys(map(int, tiers), 0)
 
         channel = Channel.get_current_magento_channel()
-        product = self.product_listing.product
-        return channel.price_list.compute(
-            None, product, product.list_price, self.quantity,
-            channel.default_uom
+        prices = channel.get_magento_prices([
+            (tier.product_listing.product, tier.quantity) for tier in tiers
+        ])
+        return dict(
+            (
+                tier.id,
+                prices[(tier.product_listing.product.id, tier.quantity)]
+            ) for tier in tiers
         )
@@ -10,16 +10,22 @@
 import magento
 from decimal import Decimal
 import xmlrpclib
+import json
+import traceback
+import zlib
+from collections import OrderedDict
 
-from trytond.model import fields
+from trytond.model import ModelSQL, ModelView, fields
 from trytond.transaction import Transaction
 from trytond.exceptions import UserError
 from trytond.pool import PoolMeta, Pool
 from trytond.pyson import Eval
+from trytond.tools import grouped_slice
+from .channel import savepoint, has_savepoint
 
 
 __all__ = [
-    'StockShipmentOut', 'Sale', 'SaleLine',
+    'StockShipmentOut', 'Sale', 'SaleLine', 'MagentoOrderPayload',
 ]
 __metaclass__ = PoolMeta
 
@@ -96,6 +102,51 @@ class Sale:
 
         return sales and sales[0] or None
 
+    @classmethod
+    def find_all_using_magento_data(cls, orders_data):
+        """
+        Finds the sales of all the given orders with a query per slice of
+        orders instead of a query per order
+
+        :param orders_data: List of order data from magento
+        :return: Dictionary of the sales found with their magento id as key
+        """
+        magento_ids = [
+            int(order_data['order_id']) for order_data in orders_data
+        ]
+        sales = {}
+        for sub_ids in grouped_slice(magento_ids):
+            for sale in cls.search([
+                ('magento_id', 'in', list(sub_ids)),
+                ('channel', '=', Transaction().context['current_channel']),
+            ]):
+                sales[sale.magento_id] = sale
+        return sales
+
+    @staticmethod
+    def get_guest_data_using_magento_data(order_data):
+        """
+        Returns the customer data of the guest who placed the order, in the
+        form sent by magento for customers
+
+        :param order_data: Order data sent by magento
+        :return: Dictionary of values for customer with a customer_id of 0
+        """
+        firstname = order_data['customer_firstname'] or (
+            order_data['billing_address'] and
+            order_data['billing_address']['firstname']
+        )
+        lastname = order_data['customer_lastname'] or (
+            order_data['billing_address'] and
+            order_data['billing_address']['lastname']
+        )
+        return {
+            'firstname': firstname,
+            'lastname': lastname,
+            'email': order_data['customer_email'],
+            'customer_id': 0
+        }
+
     @classmethod
     def get_sale_using_magento_data(cls, order_data):
         """
@@ -105,7 +156,6 @@ class Sale:
         Party = Pool().get('party.party')
         Address = Pool().get('party.address')
         Currency = Pool().get('currency.currency')
-        Uom = Pool().get('product.uom')
         Channel = Pool().get('sale.channel')
 
         channel = Channel.get_current_magento_channel()
@@ -118,21 +168,14 @@ class Sale:
             party = Party.find_or_create_using_magento_id(
                 order_data['customer_id']
             )
-        else:
-            firstname = order_data['customer_firstname'] or (
-                order_data['billing_address'] and
-                order_data['billing_address']['firstname']
+        elif channel.magento_merge_guest_customers:
+            party = Party.find_or_create_guest_using_magento_data(
+                cls.get_guest_data_using_magento_data(order_data)
             )
-            lastname = order_data['customer_lastname'] or (
-                order_data['billing_address'] and
-                order_data['billing_address']['lastname']
+        else:
+            party = Party.create_using_magento_data(
+                cls.get_guest_data_using_magento_data(order_data)
             )
-            party = Party.create_using_magento_data({
-                'firstname': firstname,
-                'lastname': lastname,
-                'email': order_data['customer_email'],
-                'customer_id': 0
-            })
 
         party_invoice_address = None
         if order_data['billing_address']:
@@ -147,7 +190,6 @@ class Sale:
                 Address.find_or_create_for_party_using_magento_data(
                     party, order_data['shipping_address']
                 )
-        unit, = Uom.search([('name', '=', 'Unit')])
 
         tryton_action = channel.get_tryton_action(order_data['state'])
 
@@ -231,6 +273,12 @@ class Sale:
         :param order_data: Order Data from magento
         """
         Bom = Pool().get('production.bom')
+        Product = Pool().get('product.product')
+
+        # Find the existing products of all the items at once
+        products = Product.find_all_using_magento_skus([
+            item['sku'] for item in order_data['items']
+        ])
 
         for item in order_data['items']:
 
@@ -240,7 +288,7 @@ class Sale:
                     item['parent_item_id']:
                 continue
 
-            sale_line = self.get_sale_line_using_magento_data(item)
+            sale_line = self.get_sale_line_using_magento_data(item, products)
             if sale_line is not None:
                 self.lines.append(sale_line)
 
@@ -259,23 +307,30 @@ class Sale:
                 self.get_discount_line_data_using_magento_data(order_data)
             )
 
-    def get_sale_line_using_magento_data(self, item):
+    def get_sale_line_using_magento_data(self, item, products=None):
         """
         Get sale.line data from magento data.
+
+        :param item: Item data from magento
+        :param products: Optional dictionary of the products already found
+                         with their SKU as key, the product of the item is
+                         imported if it is not in it
         """
         SaleLine = Pool().get('sale.line')
         ChannelException = Pool().get('channel.exception')
         Channel = Pool().get('sale.channel')
         Uom = Pool().get('product.uom')
+        ModelData = Pool().get('ir.model.data')
 
         channel = Channel.get_current_magento_channel()
 
         sale_line = None
-        unit, = Uom.search([('name', '=', 'Unit')])
+        unit = Uom(ModelData.get_id('product', 'uom_unit'))
         if not item['parent_item_id']:
             # If its a top level product, create it
             try:
-                product = channel.import_product(item['sku'])
+                product = (products or {}).get(item['sku']) or \
+                    channel.import_product(item['sku'])
             except xmlrpclib.Fault, exception:
                 if exception.faultCode == 101:
                     # Case when product doesnot exist on magento
@@ -325,10 +380,7 @@ class Sale:
         sale = cls.find_using_magento_increment_id(order_increment_id)
 
         if not sale:
-            with magento.Order(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as order_api:
+            with channel.get_magento_session(magento.Order) as order_api:
                 order_data = order_api.info(order_increment_id)
 
             sale = cls.create_using_magento_data(order_data)
@@ -385,11 +437,12 @@ class Sale:
         :param order_data: Order Data from magento
         """
         Uom = Pool().get('product.uom')
+        ModelData = Pool().get('ir.model.data')
         MagentoCarrier = Pool().get('magento.instance.carrier')
         SaleLine = Pool().get('sale.line')
 
         carrier_data = {}
-        unit, = Uom.search([('name', '=', 'Unit')])
+        unit = Uom(ModelData.get_id('product', 'uom_unit'))
 
         # Fetch carrier code from shipping_method
         # ex: shipping_method : flaterate_flaterate
@@ -427,8 +480,9 @@ class Sale:
         """
         SaleLine = Pool().get('sale.line')
         Uom = Pool().get('product.uom')
+        ModelData = Pool().get('ir.model.data')
 
-        unit, = Uom.search([('name', '=', 'Unit')])
+        unit = Uom(ModelData.get_id('product', 'uom_unit'))
 
         return SaleLine(**{
             'sale': self.id,
@@ -478,10 +532,7 @@ class Sale:
         # order status change due to its workflow constraints.
         # TODO: Find a better way to do it
         try:
-            with magento.Order(
-                channel.magento_url, channel.magento_api_user,
-                channel.magento_api_key
-            ) as order_api:
+            with channel.get_magento_session(magento.Order) as order_api:
                 if self.state == 'cancel':
                     order_api.cancel(increment_id)
                 elif self.state == 'done':
@@ -561,10 +612,7 @@ class StockShipmentOut:
             return
 
         # Add tracking info to the shipment on magento
-        with magento.Shipment(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
-        ) as shipment_api:
+        with channel.get_magento_session(magento.Shipment) as shipment_api:
             shipment_increment_id = shipment_api.addtrack(
                 self.magento_increment_id,
                 carriers[0].code,
@@ -577,3 +625,190 @@ class StockShipmentOut:
             })
 
         return shipment_increment_id
+
+
+class MagentoOrderPayload(ModelSQL, ModelView):
+    """Magento Order Payload
+
+    The data of an order as downloaded from magento, stored as zlib
+    compressed json. Downloading orders and creating sales from them are
+    done in separate stages, so that the sales of downloaded orders can be
+    created again without connecting to magento.
+    """
+    __name__ = 'magento.order.payload'
+
+    channel = fields.Many2One(
+        'sale.channel', 'Channel', required=True, readonly=True, select=True,
+        domain=[('source', '=', 'magento')]
+    )
+    increment_id = fields.Char(
+        'Increment ID', required=True, readonly=True, select=True
+    )
+    data = fields.Binary('Data', required=True, readonly=True)
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+        ('skipped', 'Skipped'),
+    ], 'State', required=True, readonly=True, select=True)
+    sale = fields.Many2One('sale.sale', 'Sale', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        """
+        Setup the class before adding to pool
+        """
+        super(MagentoOrderPayload, cls).__setup__()
+        cls._sql_constraints += [
+            (
+                'channel_increment_id_unique',
+                'UNIQUE(channel, increment_id)',
+                'An order can be downloaded only once for a channel'
+            )
+        ]
+        cls._buttons.update({
+            'retry': {
+                'invisible': Eval('state') != 'failed',
+            },
+        })
+
+    @staticmethod
+    def default_state():
+        return 'pending'
+
+    @staticmethod
+    def get_values_using_magento_data(order_data):
+        """
+        Returns the values of a pending payload for the order data
+
+        :param order_data: Order data from magento
+        """
+        return {
+            'increment_id': order_data['increment_id'],
+            'data': buffer(zlib.compress(json.dumps(order_data))),
+            'state': 'pending',
+        }
+
+    def get_order_data(self):
+        """
+        Returns the order data from magento stored in the payload
+        """
+        return json.loads(zlib.decompress(str(self.data)))
+
+    @classmethod
+    @ModelView.button
+    def retry(cls, payloads):
+        """
+        Set failed payloads back to pending to create their sales again
+        """
+        cls.write(payloads, {'state': 'pending'})
+
+    @classmethod
+    def process(cls, payloads):
+        """
+        Create sales from the pending payloads, using
+        `Sale.create_using_magento_data`.
+
+        The payloads are processed in slices. The parties of the customers
+        of a slice are found at once before its sales are created, and the
+        customers not imported yet are fetched from magento and created at
+        once. When guest customers are merged, the parties of the guests of
+        the slice are also found or created at once.
+
+        If `magento_orders_per_commit` is set on the channel of a payload,
+        the slices have that many payloads, each sale is created in a
+        savepoint and the transaction is committed after each slice. A
+        payload whose sale cannot be created is then logged as a channel
+        exception and marked as failed instead of stopping the others. On
+        databases without savepoints, see `has_savepoint`, the error is
+        raised as the sale could only be partly created.
+
+        The payloads of orders in a state which is not imported, see
+        `Sale.create_using_magento_data`, are marked as skipped.
+
+        :param payloads: List of active record of payloads
+        :return: List of active record of sale created
+        """
+        Sale = Pool().get('sale.sale')
+        Party = Pool().get('party.party')
+        ChannelException = Pool().get('channel.exception')
+
+        payloads_by_channel = OrderedDict()
+        for payload in payloads:
+            if payload.state == 'pending':
+                payloads_by_channel.setdefault(
+                    payload.channel, []
+                ).append(payload)
+
+        sales = []
+        for channel, channel_payloads in payloads_by_channel.iteritems():
+            per_commit = channel.magento_orders_per_commit
+            with Transaction().set_context(current_channel=channel.id):
+                for sub_payloads in grouped_slice(
+                    channel_payloads, per_commit or None
+                ):
+                    orders_data = [
+                        (payload, payload.get_order_data())
+                        for payload in sub_payloads
+                    ]
+                    customer_ids = [
+                        order_data['customer_id']
+                        for _, order_data in orders_data
+                        if order_data['customer_id']
+                    ]
+                    try:
+                        Party.find_or_create_all_using_magento_ids(
+                            customer_ids
+                        )
+                    except xmlrpclib.Fault:
+                        # The customers not created are fetched again with
+                        # their orders, whose failures are logged
+                        if not per_commit:
+                            raise
+                    if channel.magento_merge_guest_customers:
+                        Party.find_or_create_all_guests_using_magento_data([
+                            Sale.get_guest_data_using_magento_data(order_data)
+                            for _, order_data in orders_data
+                            if not order_data['customer_id']
+                        ])
+
+                    for payload, order_data in orders_data:
+                        if not per_commit:
+                            sale = Sale.create_using_magento_data(order_data)
+                        else:
+                            try:
+                                with savepoint('magento_order_import'):
+                                    sale = Sale.create_using_magento_data(
+                                        order_data
+                                    )
+                            except Exception:
+                                # Without savepoint, what the order wrote
+                                # before failing cannot be undone and must
+                                # not be committed
+                                if not has_savepoint():
+                                    raise
+                                ChannelException.create([{
+                                    'origin': '%s,%s' % (
+                                        channel.__name__, channel.id
+                                    ),
+                                    'log': (
+                                        "Error occurred on importing "
+                                        "order %s.\nError Message: %s" % (
+                                            payload.increment_id,
+                                            traceback.format_exc()
+                                        )
+                                    ),
+                                    'channel': channel.id,
+                                }])
+                                cls.write([payload], {'state': 'failed'})
+                                continue
+                        if sale is None:
+                            # The state of the order is not imported
+                            cls.write([payload], {'state': 'skipped'})
+                            continue
+                        cls.write([payload], {'state': 'done', 'sale': sale.id})
+                        sales.append(sale)
+
+                    if per_commit:
+                        Transaction().cursor.commit()
+        return sales
@@ -16,6 +16,7 @@ from tests.test_party import TestParty
 from tests.test_product import TestProduct
 from tests.test_sale import TestSale
 from tests.test_currency import TestCurrency
+from tests.test_api import TestSessionPool, TestThreadedImap
 
 
 def suite():
@@ -30,6 +31,8 @@ def suite():
         unittest.TestLoader().loadTestsFromTestCase(TestProduct),
         unittest.TestLoader().loadTestsFromTestCase(TestSale),
         unittest.TestLoader().loadTestsFromTestCase(TestCurrency),
+        unittest.TestLoader().loadTestsFromTestCase(TestSessionPool),
+        unittest.TestLoader().loadTestsFromTestCase(TestThreadedImap),
     ])
     return test_suite
 
@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+    benchmark_import
+
+    Benchmarks the import of orders from a fake magento with synthetic
+    orders, customers and products. The fake magento is called in process,
+    or over XML-RPC with `--server`.
+
+    Run it from the module directory with the database set in the
+    environment like the tests, for example::
+
+        DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// \\
+            python tests/benchmark_import.py --orders 500
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import sys
+import time
+import resource
+from argparse import ArgumentParser
+
+import magento
+from mock import patch
+
+from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.transaction import Transaction
+from test_base import TestBase, load_json
+from fake_magento import FakeMagento, FakeMagentoServer, stand_in
+
+
+class CountingCursor(object):
+    """
+    Wraps the cursor of the transaction to count the queries executed
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.queries = 0
+
+    def execute(self, *args, **kwargs):
+        self.queries += 1
+        return self.cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+def setup_channel(base):
+    """
+    Create the defaults of the tests and the order states and categories
+    of the channel to import orders in
+
+    :param base: The :class:`TestBase` whose defaults are created
+    """
+    Category = POOL.get('product.category')
+
+    base.setup_defaults()
+    channel = base.channel1
+    with Transaction().set_context(current_channel=channel.id):
+        for code, name in load_json('order-states', 'all').iteritems():
+            channel.create_order_state(code, name)
+        Category.create_tree_using_magento_data(
+            load_json('categories', 'category_tree')
+        )
+
+
+def benchmark(options):
+    """
+    Import the orders of a fake magento and returns the measures
+    """
+    fake = FakeMagento(
+        orders=options.orders, customers=options.customers,
+        products=options.products, latency=options.latency,
+        error_rate=options.error_rate, seed=0
+    )
+    server = None
+    if options.server:
+        server = FakeMagentoServer(fake)
+        server.start()
+
+    # Installs the module
+    base = TestBase('setup_defaults')
+    base.setUp()
+
+    with Transaction().start(DB_NAME, USER, CONTEXT):
+        setup_channel(base)
+        channel = base.channel1
+        channel.magento_multicall_batch_size = options.batch_size
+        channel.magento_order_fetch_concurrency = options.concurrency
+        channel.magento_orders_per_commit = options.orders_per_commit
+        if server:
+            channel.magento_url = server.url
+        channel.save()
+
+        transaction = Transaction()
+        counting_cursor = CountingCursor(transaction.cursor)
+        # Over XML-RPC the API classes of python-magento are kept
+        api_classes = dict(
+            (name, getattr(magento, name) if server else
+                stand_in(fake, getattr(magento, name)))
+            for name in ('Order', 'Customer', 'Product')
+        )
+        with patch.multiple('magento', **api_classes), \
+                patch.object(transaction, 'cursor', counting_cursor), \
+                Transaction().set_context(company=base.company.id):
+            start = time.time()
+            sales = channel.import_orders()
+            elapsed = time.time() - start
+
+    if server:
+        server.shutdown()
+
+    return {
+        'orders': len(sales),
+        'seconds': elapsed,
+        'queries': counting_cursor.queries,
+        'requests': fake.requests,
+        'calls': fake.calls,
+        # Kilobytes on linux
+        'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def report(measures):
+    """
+    Print the measures of a benchmark
+    """
+    orders = measures['orders'] or 1
+    print 'Orders imported:        %d' % measures['orders']
+    print 'Time:                   %.2f s' % measures['seconds']
+    print 'Orders per second:      %.2f' % (
+        measures['orders'] / measures['seconds']
+    )
+    print 'SQL queries per order:  %.1f' % (
+        float(measures['queries']) / orders
+    )
+    print 'API requests per order: %.2f' % (
+        float(measures['requests']) / orders
+    )
+    print 'API calls per order:    %.2f' % (
+        float(sum(measures['calls'].values())) / orders
+    )
+    for resource_path, count in sorted(measures['calls'].iteritems()):
+        print '    %-30s %d' % (resource_path, count)
+    print 'Peak RSS:               %.1f MB' % (measures['max_rss'] / 1024.0)
+
+
+def main(argv=None):
+    parser = ArgumentParser(
+        description='Benchmark the import of orders from a fake magento'
+    )
+    parser.add_argument(
+        '--orders', type=int, default=100, help='Number of orders to import'
+    )
+    parser.add_argument(
+        '--customers', type=int, default=20, help='Number of customers'
+    )
+    parser.add_argument(
+        '--products', type=int, default=20, help='Number of products'
+    )
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help='Number of orders fetched in a multiCall'
+    )
+    parser.add_argument(
+        '--concurrency', type=int, default=1,
+        help='Number of concurrent requests fetching orders'
+    )
+    parser.add_argument(
+        '--orders-per-commit', type=int,
+        help='Import each order in a savepoint and commit every so many '
+        'orders, so that failed orders are logged instead of raised on '
+        'databases with savepoints'
+    )
+    parser.add_argument(
+        '--server', action='store_true',
+        help='Call the fake magento over XML-RPC instead of in process'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Seconds each request to the fake magento takes'
+    )
+    parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='Share of the calls to the fake magento which fail'
+    )
+    report(benchmark(parser.parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+"""
+    fake_magento
+
+    A stand-in for magento which answers the XML-RPC API from synthetic data
+    generated from the json files in json_mock. It can be used in process or
+    served over XML-RPC, for example::
+
+        python tests/fake_magento.py --port 8000 --orders 1000 --latency 0.2
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import copy
+import random
+import threading
+import time
+import uuid
+import xmlrpclib
+from argparse import ArgumentParser
+from collections import Counter, OrderedDict
+from datetime import datetime, timedelta
+from SocketServer import ThreadingMixIn
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+
+from test_base import load_json
+
+#: Templates from json_mock which the synthetic data is generated from
+ORDER_TEMPLATE = '100000001'
+CUSTOMER_TEMPLATE = '1'
+PRODUCT_TEMPLATES = ['HTC Touch Diamond', 'micronmouse5000']
+
+
+class FakeMagento(object):
+    """
+    Magento with the given number of orders, customers and products, all
+    in store 1. The public methods are those of the magento XML-RPC API,
+    so it can be used as the client of a python-magento API (see
+    :func:`stand_in`).
+
+    Every call is counted by resource path in `calls`, including the calls
+    in a multiCall, and every request is counted in `requests`. The stock
+    and tier prices sent to magento are kept in `stock` and `tier_prices`
+    by product.
+
+    :param latency: Seconds each request takes
+    :param error_rate: Share of the calls which fail with a fault, as a
+                       float between 0 and 1
+    :param seed: Seed of the random errors
+    """
+
+    def __init__(
+        self, orders=10, customers=5, products=5, latency=0, error_rate=0,
+        seed=None
+    ):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.requests = 0
+        self.customers = OrderedDict()
+        self.products = OrderedDict()
+        self.orders = OrderedDict()
+        self.stock = {}
+        self.tier_prices = {}
+
+        customer_template = load_json('customers', CUSTOMER_TEMPLATE)
+        for index in xrange(customers):
+            customer = copy.deepcopy(customer_template)
+            customer['customer_id'] = str(index + 1)
+            customer['email'] = 'customer%d@example.com' % (index + 1)
+            customer['firstname'] = 'Customer %d' % (index + 1)
+            self.customers[customer['customer_id']] = customer
+
+        product_templates = [
+            load_json('products', sku) for sku in PRODUCT_TEMPLATES
+        ]
+        for index in xrange(products):
+            product = copy.deepcopy(
+                product_templates[index % len(product_templates)]
+            )
+            product['product_id'] = str(10000 + index)
+            product['sku'] = '%s-%d' % (product['sku'], index)
+            self.products[product['sku']] = product
+
+        order_template = load_json('orders', ORDER_TEMPLATE)
+        updated_at = datetime(2015, 1, 1)
+        customers = self.customers.values()
+        products = self.products.values()
+        for index in xrange(orders):
+            order = copy.deepcopy(order_template)
+            order_id = str(index + 1)
+            customer = customers[index % len(customers)]
+            order.update({
+                'order_id': order_id,
+                'increment_id': str(500000001 + index),
+                'customer_id': customer['customer_id'],
+                'customer_email': customer['email'],
+                'customer_firstname': customer['firstname'],
+                'updated_at': (
+                    updated_at + timedelta(seconds=index)
+                ).strftime('%Y-%m-%d %H:%M:%S'),
+            })
+            for address in (
+                order['billing_address'], order['shipping_address']
+            ):
+                address['customer_id'] = customer['customer_id']
+                address['parent_id'] = order_id
+            for item_index, item in enumerate(order['items']):
+                product = products[
+                    (index * len(order['items']) + item_index) % len(products)
+                ]
+                item.update({
+                    'item_id': str(index * len(order['items']) + item_index),
+                    'order_id': order_id,
+                    'product_id': product['product_id'],
+                    'sku': product['sku'],
+                })
+            self.orders[order['increment_id']] = order
+
+    def login(self, username, api_key):
+        return uuid.uuid4().hex
+
+    def endSession(self, session):
+        return True
+
+    def call(self, session, resource_path, arguments):
+        self.start_request()
+        return self.dispatch(resource_path, arguments)
+
+    def multiCall(self, session, calls):
+        self.start_request()
+        results = []
+        for resource_path, arguments in calls:
+            try:
+                results.append(self.dispatch(resource_path, arguments))
+            except xmlrpclib.Fault, fault:
+                results.append({
+                    'isFault': True,
+                    'faultCode': fault.faultCode,
+                    'faultMessage': fault.faultString,
+                })
+        return results
+
+    def start_request(self):
+        """
+        Count the request and wait for the latency
+        """
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def dispatch(self, resource_path, arguments):
+        """
+        Call the method which implements the resource path, for example
+        `sales_order_info` for `sales_order.info`
+        """
+        with self.lock:
+            self.calls[resource_path] += 1
+            failed = self.error_rate and self.random.random() < self.error_rate
+        if failed:
+            raise xmlrpclib.Fault(
+                1, 'Internal Error. Please see log for details.'
+            )
+        method = getattr(self, resource_path.replace('.', '_'), None)
+        if method is None:
+            raise xmlrpclib.Fault(3, 'Invalid api path.')
+        return method(*arguments)
+
+    def sales_order_list(self, filters=None):
+        return [
+            self.get_order_summary(order) for order in self.orders.values()
+            if match_filters(order, filters)
+        ]
+
+    def sales_order_search(self, options):
+        orders = self.sales_order_list(options.get('filters'))
+        limit = options.get('limit') or 1000
+        start = (options.get('page', 1) - 1) * limit
+        return {
+            'items': orders[start:start + limit],
+            'hasNext': len(orders) > start + limit,
+        }
+
+    def sales_order_info(self, increment_id, attributes=None):
+        try:
+            return self.orders[str(increment_id)]
+        except KeyError:
+            raise xmlrpclib.Fault(100, 'Requested order not exists.')
+
+    def sales_order_cancel(self, increment_id):
+        self.sales_order_info(increment_id)['state'] = 'canceled'
+        return True
+
+    def sales_order_addComment(
+        self, increment_id, status, comment=None, notify=False
+    ):
+        self.sales_order_info(increment_id)['status'] = status
+        return True
+
+    def sales_order_get_order_states(self):
+        return load_json('order-states', 'all')
+
+    def sales_order_shipping_methods(self):
+        return load_json('carriers', 'shipping_methods')
+
+    def sales_order_shipment_create(
+        self, increment_id, items_qty, comment=None, email=False,
+        include_comment=False
+    ):
+        self.sales_order_info(increment_id)
+        return increment_id
+
+    def sales_order_shipment_addTrack(
+        self, shipment_increment_id, carrier, title, track_number
+    ):
+        return 1
+
+    def customer_info(self, customer_id, attributes=None):
+        try:
+            return self.customers[str(customer_id)]
+        except KeyError:
+            raise xmlrpclib.Fault(102, 'Customer not exists.')
+
+    def customer_list(self, filters=None):
+        return [
+            customer for customer in self.customers.values()
+            if match_filters(customer, filters)
+        ]
+
+    def catalog_category_tree(self, parent_id=None, store_view=None):
+        return load_json('categories', 'category_tree')
+
+    def catalog_category_info(
+        self, category_id, store_view=None, attributes=None
+    ):
+        try:
+            return load_json('categories', str(category_id))
+        except IOError:
+            raise xmlrpclib.Fault(102, 'Category not exists.')
+
+    def catalog_product_list(self, filters=None, store_view=None):
+        return [{
+            'product_id': data['product_id'],
+            'sku': data['sku'],
+            'name': data['name'],
+            'set': data['set'],
+            'type': data['type'],
+            'category_ids': data['categories'],
+            'website_ids': data['websites'],
+        } for data in self.products.values() if match_filters(data, filters)]
+
+    def catalog_product_info(
+        self, product, store_view=None, attributes=None, identifier_type=None
+    ):
+        for data in self.products.values():
+            if str(product) in (data['sku'], data['product_id']):
+                return data
+        raise xmlrpclib.Fault(101, 'Product not exists.')
+
+    def catalog_product_attribute_set_list(self):
+        return [{'set_id': '4', 'name': 'Default'}]
+
+    def cataloginventory_stock_item_update(self, product, data):
+        self.catalog_product_info(product)
+        with self.lock:
+            self.stock[str(product)] = data
+        return True
+
+    def catalog_product_attribute_tier_price_update(
+        self, product, tier_prices, identifier_type=None
+    ):
+        self.catalog_product_info(product)
+        with self.lock:
+            self.tier_prices[str(product)] = tier_prices
+        return True
+
+    def ol_websites_list(self):
+        return [load_json('core', 'website')]
+
+    def ol_groups_list(self, filters=None):
+        return [load_json('core', 'store')]
+
+    def ol_storeviews_list(self, filters=None):
+        return [load_json('core', 'store_view')]
+
+    def ol_catalog_product_create(self, product_type, attribute_set, sku, data):
+        product = dict(load_json('products', PRODUCT_TEMPLATES[0]), **data)
+        with self.lock:
+            product.update({
+                'product_id': str(10000 + len(self.products)),
+                'sku': sku,
+                'type': product_type,
+                'set': str(attribute_set),
+            })
+            self.products[sku] = product
+        return int(product['product_id'])
+
+    @staticmethod
+    def get_order_summary(order):
+        """
+        Returns the fields of the order sent in order lists
+        """
+        return dict(
+            (key, value) for key, value in order.iteritems()
+            if key not in ('items', 'billing_address', 'shipping_address',
+                           'payment', 'status_history')
+        )
+
+
+def match_filters(record, filters):
+    """
+    Check if the record matches the magento filters, which have the format
+    `{<attribute>: {<operator>: <value>}}`. Only the operators used by this
+    module are supported.
+    """
+    for attribute, conditions in (filters or {}).iteritems():
+        value = record.get(attribute)
+        if not isinstance(conditions, dict):
+            conditions = {'eq': conditions}
+        for operator, operand in conditions.iteritems():
+            if isinstance(operand, (int, long)):
+                value = int(value)
+            elif isinstance(operand, basestring) and value is not None:
+                value = str(value)
+            if operator in ('=', 'eq'):
+                matches = value == operand
+            elif operator == 'in':
+                matches = str(value) in map(str, operand)
+            elif operator == 'gt':
+                matches = value > operand
+            elif operator == 'gteq':
+                matches = value >= operand
+            elif operator == 'lt':
+                matches = value < operand
+            elif operator == 'lteq':
+                matches = value <= operand
+            else:
+                raise xmlrpclib.Fault(
+                    104, 'Unsupported filter operator %s.' % operator
+                )
+            if not matches:
+                return False
+    return True
+
+
+def stand_in(fake_magento, api_class):
+    """
+    Returns a subclass of the python-magento API class whose client is the
+    fake magento itself, so that the API is used without any connection.
+    It can be patched in place of the API class, for example::
+
+        with patch('magento.Order', stand_in(fake, magento.Order)):
+            channel.import_orders()
+
+    :param fake_magento: The :class:`FakeMagento`
+    :param api_class: The python-magento API class, like `magento.Order`
+    """
+    def connect(self):
+        self.client = fake_magento
+
+    return type(api_class.__name__, (api_class,), {'connect': connect})
+
+
+class FakeMagentoRequestHandler(SimpleXMLRPCRequestHandler):
+    """
+    Answers on the path of the magento XML-RPC API
+    """
+    rpc_paths = ('/index.php/api/xmlrpc', '/api/xmlrpc')
+
+
+class FakeMagentoServer(ThreadingMixIn, SimpleXMLRPCServer):
+    """
+    Serves a :class:`FakeMagento` over XML-RPC, a request at a time per
+    thread. A channel can use it with `url` as magento site URL.
+
+    :param fake_magento: The :class:`FakeMagento` to serve
+    :param address: Tuple of host and port, a free port is used by default
+    """
+    daemon_threads = True
+
+    def __init__(self, fake_magento, address=('localhost', 0)):
+        SimpleXMLRPCServer.__init__(
+            self, address, requestHandler=FakeMagentoRequestHandler,
+            allow_none=True, logRequests=False
+        )
+        for method in ('login', 'endSession', 'call', 'multiCall'):
+            self.register_function(getattr(fake_magento, method), method)
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % self.server_address
+
+    def start(self):
+        """
+        Serve in a daemon thread until `shutdown` is called
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def main(argv=None):
+    parser = ArgumentParser(description='Serve a fake magento over XML-RPC')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--orders', type=int, default=100)
+    parser.add_argument('--customers', type=int, default=20)
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument(
+        '--latency', type=float, default=0, help='Seconds per request'
+    )
+    parser.add_argument(
+        '--error-rate', type=float, default=0,
+        help='Share of the calls which fail, between 0 and 1'
+    )
+    parser.add_argument('--seed', type=int, help='Seed of the random errors')
+    options = parser.parse_args(argv)
+
+    server = FakeMagentoServer(FakeMagento(
+        orders=options.orders, customers=options.customers,
+        products=options.products, latency=options.latency,
+        error_rate=options.error_rate, seed=options.seed,
+    ), (options.host, options.port))
+    print 'Serving a fake magento on %s' % server.url
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+"""
+    test_api
+
+    Tests the magento API session pool
+
+    :copyright: (c) 2015 by Openlabs Technologies & Consulting (P) Limited
+    :license: BSD, see LICENSE for more details.
+"""
+import socket
+import threading
+import time
+import unittest
+import xmlrpclib
+
+import magento
+from mock import MagicMock
+
+import trytond.tests.test_tryton
+from trytond.modules.magento.api import SessionPool, SESSION_EXPIRED_FAULT, \
+    threaded_imap
+
+
+def mock_api_class():
+    """
+    Returns a mock API class and the list to which each API instance
+    created from it is appended
+    """
+    api_class = MagicMock(spec=magento.Order)
+    handles = []
+
+    def new_api(*args):
+        handle = MagicMock(spec=magento.Order)
+        handle.__enter__.return_value = handle
+        handles.append(handle)
+        return handle
+    api_class.side_effect = new_api
+    return api_class, handles
+
+
+class TestSessionPool(unittest.TestCase):
+    """
+    Tests the session pool
+    """
+
+    def test_0010_session_is_reused(self):
+        """
+        Check that a session is logged in once and reused by later calls
+        """
+        pool = SessionPool()
+        api_class, handles = mock_api_class()
+
+        with pool.session(api_class, 'url', 'user', 'key') as api:
+            api.info('100000001')
+        with pool.session(api_class, 'url', 'user', 'key') as api:
+            api.info('100000002')
+
+        handle, = handles
+        self.assertEqual(handle.__enter__.call_count, 1)
+        self.assertEqual(handle.info.call_count, 2)
+        self.assertFalse(handle.__exit__.called)
+
+    def test_0020_sessions_are_keyed_by_credentials(self):
+        """
+        Check that different credentials do not share a session
+        """
+        pool = SessionPool()
+        api_class, handles = mock_api_class()
+
+        with pool.session(api_class, 'url', 'user', 'key'):
+            pass
+        with pool.session(api_class, 'url', 'user', 'other key'):
+            pass
+
+        self.assertEqual(len(handles), 2)
+
+    def test_0030_relogin_on_session_expiry(self):
+        """
+        Check that an expired session logs in again and retries the call
+        """
+        pool = SessionPool()
+        api_class, handles = mock_api_class()
+
+        with pool.session(api_class, 'url', 'user', 'key') as api:
+            handles[0].info.side_effect = [
+                xmlrpclib.Fault(SESSION_EXPIRED_FAULT, 'Session expired'),
+                {'increment_id': '100000001'},
+            ]
+            self.assertEqual(
+                api.info('100000001'), {'increment_id': '100000001'}
+            )
+        self.assertEqual(handles[0].__enter__.call_count, 2)
+
+    def test_0040_other_faults_are_raised(self):
+        """
+        Check that faults other than session expiry are raised and the
+        session is still given back to the pool
+        """
+        pool = SessionPool()
+        api_class, handles = mock_api_class()
+
+        with self.assertRaises(xmlrpclib.Fault):
+            with pool.session(api_class, 'url', 'user', 'key') as api:
+                handles[0].info.side_effect = xmlrpclib.Fault(
+                    100, 'Requested order not exists.'
+                )
+                api.info('100000001')
+
+        with pool.session(api_class, 'url', 'user', 'key'):
+            pass
+        self.assertEqual(len(handles), 1)
+
+    def test_0050_broken_connection_is_dropped(self):
+        """
+        Check that a session whose connection broke is not reused
+        """
+        pool = SessionPool()
+        api_class, handles = mock_api_class()
+
+        with self.assertRaises(socket.timeout):
+            with pool.session(api_class, 'url', 'user', 'key') as api:
+                handles[0].info.side_effect = socket.timeout()
+                api.info('100000001')
+
+        with pool.session(api_class, 'url', 'user', 'key'):
+            pass
+        self.assertEqual(len(handles), 2)
+
+    def test_0060_idle_sessions_are_evicted(self):
+        """
+        Check that sessions idle for longer than the timeout are closed
+        """
+        pool = SessionPool(idle_timeout=-1)
+        api_class, handles = mock_api_class()
+
+        with pool.session(api_class, 'url', 'user', 'key'):
+            pass
+        with pool.session(api_class, 'url', 'user', 'key'):
+            pass
+
+        self.assertEqual(len(handles), 2)
+        self.assertEqual(handles[0].__exit__.call_count, 1)
+
+    def test_0070_clear(self):
+        """
+        Check that clearing the pool ends the idle sessions
+        """
+        pool = SessionPool()
+        api_class, handles = mock_api_class()
+
+        with pool.session(api_class, 'url', 'user', 'key'):
+            pass
+        pool.clear()
+
+        self.assertEqual(handles[0].__exit__.call_count, 1)
+
+
+class TestThreadedImap(unittest.TestCase):
+    """
+    Tests the threaded map used to fetch data concurrently
+    """
+
+    def test_0010_results_in_order(self):
+        """
+        Check that the results are in the order of the items even when
+        later items finish first
+        """
+        def slow_square(item):
+            time.sleep((5 - item) * 0.01)
+            return item * item
+
+        self.assertEqual(
+            list(threaded_imap(slow_square, range(5), 3)),
+            [0, 1, 4, 9, 16]
+        )
+
+    def test_0020_running_calls_are_bounded(self):
+        """
+        Check that no more than max_workers calls run at a time
+        """
+        lock = threading.Lock()
+        running = [0]
+        most_running = [0]
+
+        def call(item):
+            with lock:
+                running[0] += 1
+                most_running[0] = max(most_running[0], running[0])
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return item
+
+        self.assertEqual(list(threaded_imap(call, range(10), 3)), range(10))
+        self.assertTrue(1 < most_running[0] <= 3)
+
+    def test_0030_errors_are_raised(self):
+        """
+        Check that an exception raised by a call is raised to the caller
+        """
+        def call(item):
+            if item == 2:
+                raise xmlrpclib.Fault(100, 'Requested order not exists.')
+            return item
+
+        results = threaded_imap(call, range(5), 2)
+        self.assertEqual(next(results), 0)
+        self.assertEqual(next(results), 1)
+        self.assertRaises(xmlrpclib.Fault, next, results)
+
+
+def suite():
+    """
+    Test Suite
+    """
+    test_suite = trytond.tests.test_tryton.suite()
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestSessionPool)
+    )
+    test_suite.addTests(
+        unittest.TestLoader().loadTestsFromTestCase(TestThreadedImap)
+    )
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.TextTestRunner(verbosity=2).run(suite())
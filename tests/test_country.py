@@ -12,6 +12,7 @@ import os
 
 import unittest
 
+from mock import patch
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import DB_NAME, USER, CONTEXT
 from trytond.transaction import Transaction
@@ -109,6 +110,95 @@ class TestCountry(TestBase):
                 None
             )
 
+    def test_0050_lookups_are_cached(self):
+        """
+        Tests that country and state lookups are cached and that the cache
+        is cleared when they are changed
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            country = self.Country.search_using_magento_code('US')
+            self.assertEqual(
+                self.Subdivision.search_using_magento_region('abc', country),
+                None
+            )
+
+            with patch.object(self.Country, 'search') as country_search:
+                with patch.object(
+                    self.Subdivision, 'search'
+                ) as subdivision_search:
+                    self.assertEqual(
+                        self.Country.search_using_magento_code('US'), country
+                    )
+                    self.assertEqual(
+                        self.Subdivision.search_using_magento_region(
+                            'ABC', country
+                        ), None
+                    )
+            self.assertFalse(country_search.called)
+            self.assertFalse(subdivision_search.called)
+
+            subdivision, = self.Subdivision.create([{
+                'name': 'Abc',
+                'code': 'US-ABC',
+                'type': 'state',
+                'country': country.id,
+            }])
+            self.assertEqual(
+                self.Subdivision.search_using_magento_region('abc', country),
+                subdivision
+            )
+
+    def test_0060_regions_of_a_country_found_with_one_search(self):
+        """
+        Tests that the regions of a country are all found with a single
+        search of its subdivisions, whatever their case
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            country = self.Country.search_using_magento_code('US')
+            florida, = self.Subdivision.search([('name', '=', 'Florida')])
+            self.Subdivision.create([{
+                'name': 'Texas',
+                'code': 'US-TX',
+                'type': 'state',
+                'country': country.id,
+            }])
+
+            with patch.object(
+                self.Subdivision, 'search', wraps=self.Subdivision.search
+            ) as subdivision_search:
+                self.assertEqual(
+                    self.Subdivision.search_using_magento_region(
+                        'FLORIDA', country
+                    ), florida
+                )
+                self.assertEqual(
+                    self.Subdivision.search_using_magento_region(
+                        'texas', country
+                    ).code, 'US-TX'
+                )
+                self.assertIsNone(
+                    self.Subdivision.search_using_magento_region(
+                        'Flor', country
+                    )
+                )
+            self.assertEqual(subdivision_search.call_count, 1)
+
+            # Names are translated, the map is built for each language
+            with patch.object(
+                self.Subdivision, 'search', wraps=self.Subdivision.search
+            ) as subdivision_search:
+                with Transaction().set_context(language='fr_FR'):
+                    self.assertEqual(
+                        self.Subdivision.search_using_magento_region(
+                            'Florida', country
+                        ), florida
+                    )
+            self.assertEqual(subdivision_search.call_count, 1)
+
 
 def suite():
     """
@@ -11,6 +11,8 @@ import os
 import sys
 import unittest
 
+from mock import patch
+
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
 from test_base import TestBase, load_json
@@ -285,6 +287,190 @@ class TestParty(TestBase):
                 address.match_with_magento_data(load_json('addresses', '1e'))
             )
 
+            # Same address with a different case, as found by fingerprint
+            self.assertTrue(
+                address.match_with_magento_data(dict(
+                    address_data, street=address_data['street'].upper()
+                ))
+            )
+
+    def test0045_find_address_by_fingerprint(self):
+        """
+        Tests that addresses are found by their fingerprint, which follows
+        the changes of the addresses
+        """
+        Address = POOL.get('party.address')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            address_data = load_json('addresses', '1')
+            address = Address.find_or_create_for_party_using_magento_data(
+                self.party, address_data
+            )
+            self.assertTrue(address.magento_fingerprint)
+
+            # The addresses of the party are not walked
+            with patch.object(
+                Address, 'match_with_magento_data', side_effect=AssertionError
+            ):
+                self.assertEqual(
+                    Address.find_or_create_for_party_using_magento_data(
+                        self.party, dict(
+                            address_data,
+                            city=' %s ' % address_data['city'].upper()
+                        )
+                    ), address
+                )
+
+            # The fingerprint is updated with the address
+            Address.write([address], {'city': 'Another City'})
+            self.assertNotEqual(
+                Address.find_or_create_for_party_using_magento_data(
+                    self.party, address_data
+                ), address
+            )
+            self.assertEqual(
+                Address.find_or_create_for_party_using_magento_data(
+                    self.party, dict(address_data, city='Another City')
+                ), address
+            )
+
+            # Addresses without fingerprint get one when the module is
+            # updated
+            Transaction().cursor.execute(
+                'UPDATE party_address SET magento_fingerprint = NULL'
+            )
+            Address.fill_magento_fingerprint()
+            self.assertFalse(
+                Address.search([('magento_fingerprint', '=', None)])
+            )
+            self.assertEqual(
+                Address.find_or_create_for_party_using_magento_data(
+                    self.party, dict(address_data, city='Another City')
+                ), address
+            )
+
+    def test0050_identity_map(self):
+        """
+        Tests that the parties of customers found or created once are found
+        again without any query
+        """
+        MagentoParty = POOL.get('sale.channel.magento.party')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(current_channel=self.channel1.id):
+                party = self.Party.create_using_magento_data(
+                    load_json('customers', '1')
+                )
+                self.Party.get_magento_identity_map().clear()
+
+                self.assertEqual(
+                    self.Party.find_all_using_magento_ids(['1', '2']),
+                    {1: party}
+                )
+                with patch.object(
+                    MagentoParty, 'search', side_effect=AssertionError
+                ):
+                    self.assertEqual(
+                        self.Party.find_using_magento_id('1'), party
+                    )
+                    self.assertEqual(
+                        self.Party.find_using_magento_data(
+                            load_json('customers', '1')
+                        ), party
+                    )
+
+            # The map is kept by channel
+            with Transaction().set_context(current_channel=self.channel2.id):
+                self.assertIsNone(self.Party.find_using_magento_id('1'))
+
+            # The map does not outlive the transaction
+            Transaction().cursor.rollback()
+            self.assertFalse(self.Party.get_magento_identity_map())
+
+    def test0060_merge_guests(self):
+        """
+        Tests that guests with the same email are found for a single party
+        """
+        MagentoParty = POOL.get('sale.channel.magento.party')
+
+        guest_data = {
+            'firstname': 'Guest',
+            'lastname': 'Customer',
+            'email': 'Guest@Example.com ',
+            'customer_id': 0,
+        }
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context(current_channel=self.channel1.id):
+                # Guests are not merged unless asked to
+                self.Party.create_using_magento_data(guest_data)
+                self.Party.create_using_magento_data(guest_data)
+                self.assertEqual(
+                    MagentoParty.search([
+                        ('guest_email', '=', 'guest@example.com'),
+                    ], count=True), 2
+                )
+                oldest = MagentoParty.search(
+                    [('guest_email', '=', 'guest@example.com')],
+                    order=[('id', 'ASC')], limit=1
+                )[0].party
+                self.Party.get_magento_identity_map().clear()
+
+                parties = \
+                    self.Party.find_or_create_all_guests_using_magento_data([
+                        guest_data,
+                        dict(guest_data, email='GUEST@example.com'),
+                        dict(guest_data, email='other@example.com'),
+                        dict(guest_data, email='Other@example.com'),
+                        dict(guest_data, email=None),
+                    ])
+                self.assertEqual(
+                    sorted(parties), ['guest@example.com', 'other@example.com']
+                )
+                self.assertEqual(parties['guest@example.com'], oldest)
+                self.assertEqual(
+                    MagentoParty.search([
+                        ('guest_email', '=', 'other@example.com'),
+                    ], count=True), 1
+                )
+
+                with patch.object(
+                    MagentoParty, 'search', side_effect=AssertionError
+                ):
+                    self.assertEqual(
+                        self.Party.find_or_create_guest_using_magento_data(
+                            dict(guest_data, email='other@EXAMPLE.com')
+                        ), parties['other@example.com']
+                    )
+
+                # Guests imported before their email was stored are found
+                # once the module is updated
+                other_guest = self.Party.create_using_magento_data(
+                    dict(guest_data, email='Older@Example.com')
+                )
+                MagentoParty.write(list(other_guest.magento_ids), {
+                    'guest_email': None,
+                })
+                MagentoParty.fill_guest_email()
+                self.assertEqual(
+                    self.Party.find_or_create_guest_using_magento_data(
+                        dict(guest_data, email='older@example.com')
+                    ), other_guest
+                )
+
+            # Guests are kept by channel
+            with Transaction().set_context(current_channel=self.channel2.id):
+                self.assertNotEqual(
+                    self.Party.find_or_create_guest_using_magento_data(
+                        guest_data
+                    ), oldest
+                )
+
 
 def suite():
     """
@@ -8,6 +8,7 @@
 import sys
 import os
 from decimal import Decimal
+from datetime import datetime
 
 import unittest
 import magento
@@ -15,7 +16,9 @@ from mock import patch, MagicMock
 
 import trytond.tests.test_tryton
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.modules.magento import channel
 from test_base import TestBase, load_json
+from fake_magento import FakeMagento, stand_in
 from trytond.transaction import Transaction
 
 DIR = os.path.abspath(os.path.normpath(
@@ -34,6 +37,7 @@ def mock_inventory_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.Inventory)
     handle.update.side_effect = lambda id, data: True
+    handle.multiCall.side_effect = lambda calls: [True] * len(calls)
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -158,6 +162,137 @@ class TestProduct(TestBase):
                     count=True) == 0
                 )
 
+    def test_0025_import_products_using_skus(self):
+        """
+        Test that the products of many SKUs are found at once and only the
+        missing ones are fetched from magento
+        """
+        Category = POOL.get('product.category')
+        Product = POOL.get('product.product')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                product = Product.find_or_create_using_magento_data(
+                    load_json('products', '135')
+                )
+
+                self.assertEqual(
+                    Product.find_all_using_magento_skus(
+                        [product.code, product.code, 'unknown']
+                    ), {product.code: product}
+                )
+
+                product_api = mock_product_api()
+                with patch('magento.Product', product_api, create=True):
+                    products = self.channel1.import_products_using_skus(
+                        [product.code, '17-wo-category']
+                    )
+
+                product_api.return_value.info.assert_called_once_with(
+                    '17-wo-category'
+                )
+                self.assertEqual(products[product.code], product)
+                self.assertEqual(
+                    products['17-wo-category'].name,
+                    load_json('products', '17-wo-category')['name']
+                )
+
+    def test_0027_import_products_in_pages(self):
+        """
+        Test the import of the catalog in pages, with an import which stops
+        and is resumed by the next import
+        """
+        Channel = POOL.get('sale.channel')
+        Product = POOL.get('product.product')
+
+        fake = FakeMagento(orders=0, customers=1, products=5)
+        import_page = Channel.import_products_using_magento_data.im_func
+        pages = []
+
+        def stop_on_second_page(self, magento_products):
+            pages.append([p['sku'] for p in magento_products])
+            if len(pages) == 2:
+                raise KeyboardInterrupt
+            return import_page(self, magento_products)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.channel1.magento_multicall_batch_size = 1
+            self.channel1.save()
+
+            category = stand_in(fake, magento.Category)
+            with Transaction().set_context(company=self.company.id), \
+                    patch('magento.Product', stand_in(fake, magento.Product)), \
+                    patch('magento.Category', category), \
+                    patch.object(channel, 'PRODUCT_PAGE_SIZE', 2), \
+                    patch.object(Transaction().cursor, 'commit'):
+                with patch.object(
+                    Channel, 'import_products_using_magento_data',
+                    stop_on_second_page
+                ):
+                    self.assertRaises(
+                        KeyboardInterrupt, self.channel1.import_products
+                    )
+                self.assertEqual(self.channel1.magento_last_product_id, 10001)
+                self.assertEqual(Product.search([], count=True), 2)
+
+                product_ids = self.channel1.import_products()
+
+            self.assertEqual(len(product_ids), 3)
+            self.assertEqual(Product.search([], count=True), 5)
+            self.assertIsNone(self.channel1.magento_last_product_id)
+            self.assertEqual(fake.calls['catalog_product.info'], 5)
+            self.assertEqual(fake.calls['catalog_product.list'], 2)
+            self.assertEqual(fake.requests, 2 + 5 + 2)
+
+    def test_0029_update_changed_products(self):
+        """
+        Test that the catalog update only fetches the products which
+        changed on magento since the last update
+        """
+        fake = FakeMagento(orders=0, customers=1, products=3)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            category = stand_in(fake, magento.Category)
+            with Transaction().set_context(company=self.company.id), \
+                    patch('magento.Product', stand_in(fake, magento.Product)), \
+                    patch('magento.Category', category), \
+                    patch.object(Transaction().cursor, 'commit'):
+                self.channel1.import_products()
+
+                # All the products are updated the first time
+                self.assertEqual(
+                    len(self.channel1.update_magento_products()), 3
+                )
+                self.assertTrue(self.channel1.last_product_update_time)
+
+                self.channel1.last_product_update_time = datetime(2015, 1, 1)
+                self.channel1.save()
+                product_data = fake.products.values()[1]
+                product_data['updated_at'] = '2015-01-02 00:00:00'
+                product_data['name'] = 'Changed Product'
+
+                fake.calls.clear()
+                product, = self.channel1.update_magento_products()
+
+            self.assertEqual(product.code, product_data['sku'])
+            self.assertEqual(product.name, 'Changed Product')
+            self.assertEqual(fake.calls['catalog_product.info'], 1)
+            self.assertTrue(
+                self.channel1.last_product_update_time >
+                datetime(2015, 1, 1)
+            )
+
     def test_0300_import_product_wo_categories(self):
         """
         Test the import of a product using magento data which doesn't
@@ -400,8 +535,193 @@ class TestProduct(TestBase):
 
                 with patch(
                     'magento.Inventory', mock_inventory_api(), create=True
-                ):
-                    self.channel1.export_inventory_to_magento()
+                ) as inventory_api:
+                    products = self.channel1.export_inventory_to_magento()
+
+                handle = inventory_api.return_value
+                self.assertFalse(handle.update.called)
+                handle.multiCall.assert_called_once_with([
+                    ['cataloginventory_stock_item.update', [
+                        listing.product_identifier,
+                        {'qty': 0, 'is_in_stock': '0'},
+                    ]] for listing in self.channel1.product_listings
+                ])
+                self.assertEqual(len(products), 1)
+
+    def test_0085_export_stock_information_in_batches(self):
+        """
+        Checks that the stock of products is exported in multiCalls of the
+        batch size of the channel and that failed updates are logged
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        ChannelException = POOL.get('channel.exception')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.channel1.magento_multicall_batch_size = 1
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                for magento_id in ('135', '17-wo-category'):
+                    Product.find_or_create_using_magento_data(
+                        load_json('products', magento_id)
+                    )
+
+                inventory_api = mock_inventory_api()
+                handle = inventory_api.return_value
+                handle.multiCall.side_effect = [[True], [{
+                    'isFault': True,
+                    'faultCode': 101,
+                    'faultMessage': 'Product not exists.',
+                }]]
+                with patch('magento.Inventory', inventory_api, create=True):
+                    products = self.channel1.export_inventory_to_magento()
+
+                self.assertEqual(len(products), 1)
+                self.assertEqual(handle.multiCall.call_count, 2)
+                self.assertEqual(handle.__enter__.call_count, 1)
+                self.assertEqual(ChannelException.search([], count=True), 1)
+
+    def test_0087_export_only_changed_stock_information(self):
+        """
+        Checks that only the stock of products which changed or failed to
+        be exported since the last export is sent again
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Location = POOL.get('stock.location')
+        Move = POOL.get('stock.move')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                products = [
+                    Product.find_or_create_using_magento_data(
+                        load_json('products', magento_id)
+                    ) for magento_id in ('135', '17-wo-category')
+                ]
+
+                inventory_api = mock_inventory_api()
+                handle = inventory_api.return_value
+                handle.multiCall.side_effect = [[True, {
+                    'isFault': True,
+                    'faultCode': 1,
+                    'faultMessage': 'Internal Error.',
+                }]]
+                with patch('magento.Inventory', inventory_api, create=True):
+                    self.assertEqual(
+                        self.channel1.export_inventory_to_magento(),
+                        products[:1]
+                    )
+
+                # Nothing changed, only the failed product is sent again
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    self.assertEqual(
+                        self.channel1.export_inventory_to_magento(),
+                        products[1:]
+                    )
+
+                # Nothing to send at all
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    self.assertEqual(
+                        self.channel1.export_inventory_to_magento(), []
+                    )
+                self.assertFalse(inventory_api.return_value.multiCall.called)
+
+                supplier, = Location.search([('code', '=', 'SUP')])
+                storage, = Location.search([('code', '=', 'STO')])
+                move, = Move.create([{
+                    'product': products[0].id,
+                    'uom': products[0].default_uom.id,
+                    'quantity': 5,
+                    'from_location': supplier.id,
+                    'to_location': storage.id,
+                    'unit_price': Decimal('1'),
+                    'currency': self.company.currency.id,
+                    'company': self.company.id,
+                }])
+                Move.do([move])
+
+                inventory_api = mock_inventory_api()
+                with patch('magento.Inventory', inventory_api, create=True):
+                    self.assertEqual(
+                        self.channel1.export_inventory_to_magento(),
+                        products[:1]
+                    )
+                inventory_api.return_value.multiCall.assert_called_once_with([
+                    ['cataloginventory_stock_item.update', [
+                        products[0].channel_listings[0].product_identifier,
+                        {'qty': 5.0, 'is_in_stock': '1'},
+                    ]]
+                ])
+
+    def test_0089_stock_quantities(self):
+        """
+        Checks the quantities of the stock exported, with a storage location
+        inside another one
+        """
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+        Location = POOL.get('stock.location')
+        Move = POOL.get('stock.move')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                products = [
+                    Product.find_or_create_using_magento_data(
+                        load_json('products', magento_id)
+                    ) for magento_id in ('135', '17-wo-category')
+                ]
+
+                supplier, = Location.search([('code', '=', 'SUP')])
+                storage, = Location.search([('code', '=', 'STO')])
+                shelf, = Location.create([{
+                    'name': 'Shelf',
+                    'type': 'storage',
+                    'parent': storage.id,
+                }])
+                moves = Move.create([{
+                    'product': products[0].id,
+                    'uom': products[0].default_uom.id,
+                    'quantity': quantity,
+                    'from_location': supplier.id,
+                    'to_location': location.id,
+                    'unit_price': Decimal('1'),
+                    'currency': self.company.currency.id,
+                    'company': self.company.id,
+                } for quantity, location in ((3, storage), (5, shelf))])
+                Move.do(moves)
+
+                self.assertEqual(
+                    self.channel1.get_magento_stock_quantities(products), {
+                        products[0].id: 8,
+                        products[1].id: 0,
+                    }
+                )
 
     def test_0090_tier_prices(self):
         """Checks the function field on product price tiers
@@ -451,6 +771,94 @@ class TestProduct(TestBase):
                     listing.product.list_price * Decimal('0.9'), tier.price
                 )
 
+                tiers = ProductPriceTier.create([{
+                    'product_listing': listing.id,
+                    'quantity': quantity,
+                } for quantity in (1, 20)])
+                self.assertEqual(
+                    ProductPriceTier.get_price(tiers, 'price'), {
+                        tiers[0].id: listing.product.list_price,
+                        tiers[1].id: (
+                            listing.product.list_price * Decimal('0.9')
+                        ),
+                    }
+                )
+
+    def test_0095_magento_prices(self):
+        """
+        Checks that the prices computed at once by a channel are the prices
+        of its price list
+        """
+        PriceList = POOL.get('product.price_list')
+        Product = POOL.get('product.product')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+                'company': self.company.id,
+            }):
+                Category.create_using_magento_data(
+                    load_json('categories', '17')
+                )
+                products = [
+                    Product.find_or_create_using_magento_data(
+                        load_json('products', magento_id)
+                    ) for magento_id in ('135', '17-wo-category')
+                ]
+
+                price_list, = PriceList.create([{
+                    'name': 'Test Pricelist',
+                    'lines': [('create', [{
+                        'sequence': 1,
+                        'product': products[0].id,
+                        'quantity': 5,
+                        'formula': 'unit_price*0.5',
+                    }, {
+                        'sequence': 2,
+                        'quantity': 20,
+                        'formula': 'unit_price*0.8',
+                    }, {
+                        'sequence': 3,
+                        'quantity': 10,
+                        'formula': 'unit_price*0.9',
+                    }])]
+                }])
+                self.channel1.price_list = price_list
+                self.channel1.save()
+
+                quantities = [1, 5, 10, 20]
+                prices = self.channel1.get_magento_prices([
+                    (product, quantity)
+                    for product in products for quantity in quantities
+                ])
+
+                self.assertEqual(len(prices), 8)
+                for product in products:
+                    for quantity in quantities:
+                        self.assertEqual(
+                            prices[(product.id, quantity)],
+                            price_list.compute(
+                                None, product, product.list_price, quantity,
+                                self.channel1.default_uom
+                            )
+                        )
+                self.assertEqual(
+                    prices[(products[1].id, 10)],
+                    products[1].list_price * Decimal('0.9')
+                )
+
+                # Prices come from the price list, once for each pair
+                with patch.object(
+                    PriceList, 'compute', return_value=Decimal('42')
+                ) as compute:
+                    prices = self.channel1.get_magento_prices([
+                        (products[0], 1), (products[0], 1), (products[1], 1)
+                    ])
+                self.assertEqual(compute.call_count, 2)
+                self.assertEqual(set(prices.values()), set([Decimal('42')]))
+
     def test_0110_export_catalog(self):
         """
         Check the export of product catalog to magento.
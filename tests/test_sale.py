@@ -12,15 +12,21 @@ import os
 from decimal import Decimal
 
 import unittest
+import functools
+import xmlrpclib
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 
 import magento
 from mock import patch, MagicMock
+from sql import Table
 import trytond.tests.test_tryton
 from trytond.transaction import Transaction
+from trytond.exceptions import UserError
 from trytond.tests.test_tryton import POOL, USER, DB_NAME, CONTEXT
+from trytond.modules.magento import channel
 from test_base import TestBase, load_json
+from fake_magento import FakeMagento, FakeMagentoServer, stand_in
 
 DIR = os.path.abspath(os.path.normpath(
     os.path.join(
@@ -46,12 +52,31 @@ def mock_product_api(mock=None, data=None):
     return mock
 
 
+def mock_order_multicall(calls):
+    """
+    Returns the info of orders for a multiCall of sales_order.info calls.
+    Orders which do not exist in the json files are returned as faults.
+    """
+    results = []
+    for resource_path, (increment_id,) in calls:
+        try:
+            results.append(load_json('orders', str(increment_id)))
+        except IOError:
+            results.append({
+                'isFault': True,
+                'faultCode': 100,
+                'faultMessage': 'Requested order not exists.',
+            })
+    return results
+
+
 def mock_order_api(mock=None, data=None):
     if mock is None:
         mock = MagicMock(spec=magento.Order)
 
     handle = MagicMock(spec=magento.Order)
     handle.info.side_effect = lambda id: load_json('orders', str(id))
+    handle.multiCall.side_effect = mock_order_multicall
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -95,6 +120,7 @@ def mock_tier_price_api(mock=None, data=None):
 
     handle = MagicMock(spec=magento.ProductTierPrice)
     handle.update.side_effect = lambda *args, **kwargs: 'Prices Exported'
+    handle.multiCall.side_effect = lambda calls: [True] * len(calls)
     if data is None:
         handle.__enter__.return_value = handle
     else:
@@ -1104,12 +1130,14 @@ class TestSale(TestBase):
                     datetime.utcnow().date()
                 )
 
-    def test_0110_export_tier_prices_to_magento_using_last_import_time(self):
+    def test_0125_export_only_changed_tier_prices_to_magento(self):
         """
-        Tests if tier prices is exported for the product only which has changed
-        after last tier price export time
+        Tests if tier prices are computed only for the listings which may
+        have changed and exported only for the listings whose tier prices
+        changed since they were last exported
         """
         Sale = POOL.get('sale.sale')
+        PriceListLine = POOL.get('product.price_list.line')
         Category = POOL.get('product.category')
         ChannelListing = POOL.get('product.product.channel_listing')
         ProductPriceTier = POOL.get('product.price_tier')
@@ -1176,30 +1204,102 @@ class TestSale(TestBase):
                     'quantity': 10,
                 }])
 
-                self.channel1.last_product_price_export_time = \
-                    datetime.utcnow()
-                self.channel1.save()
+                def export_product_prices():
+                    tier_price_api = mock_tier_price_api()
+                    with patch(
+                        'magento.ProductTierPrice', tier_price_api,
+                        create=True
+                    ):
+                        exported = self.channel1.export_product_prices()
+                    return exported, tier_price_api.return_value
+
+                def computed_products():
+                    # Products whose tier prices an export computes
+                    with patch.object(
+                        self.channel1, 'get_magento_prices',
+                        wraps=self.channel1.get_magento_prices
+                    ) as get_magento_prices:
+                        export_product_prices()
+                    return set(
+                        product for product, _ in
+                        get_magento_prices.call_args[0][0]
+                    )
 
-                # Change product1's values and prices will get exported
-                # only for this updated product only
+                def age_records():
+                    # Records are changed within the same second as the
+                    # exports by the test
+                    for table in (
+                        'product_product', 'product_template',
+                        'product_product_channel_listing',
+                        'product_price_tier', 'product_price_list',
+                        'product_price_list_line',
+                        'sale_channel_magento_price_tier',
+                    ):
+                        sql_table = Table(table)
+                        Transaction().cursor.execute(*sql_table.update(
+                            [sql_table.create_date, sql_table.write_date],
+                            [datetime(2000, 1, 1), datetime(2000, 1, 1)]
+                        ))
+
+                exported, tier_price_api = export_product_prices()
+                self.assertEqual(exported, 2)
+                self.assertEqual(tier_price_api.multiCall.call_count, 1)
+                self.assertFalse(tier_price_api.update.called)
+
+                # Nothing changed
+                exported, tier_price_api = export_product_prices()
+                self.assertEqual(exported, 0)
+                self.assertFalse(tier_price_api.multiCall.called)
+
+                # Nothing changed, nothing is computed
+                age_records()
+                self.assertEqual(computed_products(), set())
+
+                # A change which does not change the prices
                 product1.template.cost_price = 20
                 product1.template.save()
+                exported, tier_price_api = export_product_prices()
+                self.assertEqual(exported, 0)
+
+                # Only the tier prices of product1 changed
+                age_records()
+                product1.list_price = product1.list_price + 1
+                product1.save()
+                self.assertEqual(computed_products(), set([product1]))
+                product1.list_price = product1.list_price + 1
+                product1.save()
+                exported, tier_price_api = export_product_prices()
+                self.assertEqual(exported, 1)
+                tier_price_api.multiCall.assert_called_once_with([[
+                    'catalog_product_attribute_tier_price.update', [
+                        product_listing1.product_identifier, [{
+                            'qty': 10,
+                            'price': float(
+                                self.channel1.price_list.compute(
+                                    None, product1, product1.list_price,
+                                    10, self.channel1.default_uom
+                                )
+                            ),
+                        }], None
+                    ]
+                ]])
+
+                # A change of the price list changes all the tier prices
+                age_records()
+                PriceListLine.write(list(self.channel1.price_list.lines), {
+                    'formula': 'unit_price * 0.5',
+                })
+                exported, tier_price_api = export_product_prices()
+                self.assertEqual(exported, 2)
 
-                self.assertTrue(
-                    product1.template.write_date >
-                    self.channel1.last_product_price_export_time
+                # So does a change of the default price tiers of the channel
+                age_records()
+                self.channel1.magento_price_tiers = [{'quantity': 5}]
+                self.channel1.save()
+                self.assertEqual(
+                    computed_products(), set([product1, product2])
                 )
 
-                # Export tier prices to magento
-                with patch(
-                    'magento.ProductTierPrice', mock_tier_price_api(),
-                    create=True
-                ):
-                    product_listings = \
-                        self.channel1.export_product_prices()
-
-                    self.assertEqual(product_listings, 1)
-
     def test_0090_find_or_create_order_using_magento_id(self):
         """
         Tests if magento_id is not copied in duplicate sales
@@ -1256,6 +1356,794 @@ class TestSale(TestBase):
                 self.assertEqual(len(new_sales), 1)
                 self.assertIsNone(new_sales[0].magento_id)
 
+    def test_0130_import_orders_in_batches(self):
+        """
+        Tests that orders are fetched in multiCall batches and that a fault
+        for an order fails only that order
+        """
+        Category = POOL.get('product.category')
+        ChannelException = POOL.get('channel.exception')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            order_api = mock_order_api()
+            order_api.return_value.search.return_value = {
+                'hasNext': False,
+                'items': [{
+                    'order_id': '1', 'increment_id': '100000001',
+                }, {
+                    'order_id': '99', 'increment_id': '100000099',
+                }],
+            }
+            with Transaction().set_context(company=self.company.id):
+                with patch('magento.Order', order_api, create=True):
+                    with patch(
+                        'magento.Customer', mock_customer_api(), create=True
+                    ):
+                        with patch(
+                            'magento.Product', mock_product_api(),
+                            create=True
+                        ):
+                            with patch.object(
+                                Transaction().cursor, 'commit'
+                            ):
+                                sales = self.channel1.import_orders()
+
+            self.assertEqual(len(sales), 1)
+            self.assertEqual(sales[0].reference, 'mag_100000001')
+
+            # Both orders are fetched in a single request
+            self.assertEqual(order_api.return_value.multiCall.call_count, 1)
+            self.assertFalse(order_api.return_value.info.called)
+
+            exception, = ChannelException.search([
+                ('channel', '=', self.channel1.id),
+            ])
+            self.assertTrue('100000099' in exception.log)
+
+    def test_0135_multicall_settings_must_be_positive(self):
+        """
+        Tests that the batch size and concurrencies of a channel cannot be
+        zero
+        """
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            field_names = [
+                'magento_multicall_batch_size',
+                'magento_order_fetch_concurrency',
+                'magento_product_fetch_concurrency',
+            ]
+            for field_name in field_names:
+                values = dict.fromkeys(field_names, 1)
+                values[field_name] = 0
+                self.assertRaises(
+                    UserError, self.Channel.write, [self.channel1], values
+                )
+            self.Channel.write([self.channel1], dict.fromkeys(field_names, 1))
+
+    def test_0140_import_orders_page_at_a_time(self):
+        """
+        Tests that each page of orders is imported and committed before the
+        next page is fetched
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            pages = {
+                1: {
+                    'hasNext': True,
+                    'items': [{
+                        'order_id': '1', 'increment_id': '100000001',
+                    }],
+                },
+                2: {
+                    'hasNext': False,
+                    'items': [{
+                        'order_id': '4', 'increment_id': '100000004',
+                    }],
+                },
+            }
+            sales_before_page = {}
+
+            def search(filters, limit, page):
+                sales_before_page[page] = Sale.search_count([])
+                return pages[page]
+
+            order_api = mock_order_api()
+            order_api.return_value.search.side_effect = search
+            with Transaction().set_context(company=self.company.id):
+                with patch('magento.Order', order_api, create=True):
+                    with patch(
+                        'magento.Customer', mock_customer_api(), create=True
+                    ):
+                        with patch(
+                            'magento.Product', mock_product_api(),
+                            create=True
+                        ):
+                            with patch.object(
+                                Transaction().cursor, 'commit'
+                            ) as commit:
+                                sales = self.channel1.import_orders()
+
+            self.assertEqual(len(sales), 2)
+            self.assertEqual(sales_before_page, {1: 0, 2: 1})
+            self.assertEqual(commit.call_count, 2)
+            self.assertTrue(self.channel1.last_order_import_time)
+
+    def test_0150_import_orders_skips_existing(self):
+        """
+        Tests that orders which are already imported are found in bulk and
+        not fetched from magento again
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            orders_summaries = [{
+                'order_id': '1', 'increment_id': '100000001',
+            }, {
+                'order_id': '4', 'increment_id': '100000004',
+            }]
+            order_api = mock_order_api()
+            with Transaction().set_context({
+                'company': self.company.id,
+                'current_channel': self.channel1.id,
+            }):
+                with patch('magento.Order', order_api, create=True):
+                    with patch(
+                        'magento.Customer', mock_customer_api(), create=True
+                    ):
+                        with patch(
+                            'magento.Product', mock_product_api(),
+                            create=True
+                        ):
+                            sales = self.channel1 \
+                                .import_orders_using_magento_data(
+                                    orders_summaries
+                                )
+                            self.assertEqual(
+                                Sale.find_all_using_magento_data(
+                                    orders_summaries
+                                ),
+                                dict((s.magento_id, s) for s in sales)
+                            )
+
+                            # Import again, nothing is fetched this time
+                            self.assertEqual(
+                                self.channel1.import_orders_using_magento_data(
+                                    orders_summaries
+                                ), sales
+                            )
+
+            self.assertEqual(order_api.return_value.multiCall.call_count, 1)
+            self.assertEqual(Sale.search_count([]), 2)
+
+    def test_0160_import_orders_with_periodic_commits(self):
+        """
+        Tests that with orders per commit set on the channel, an order which
+        fails to import is logged and skipped and the import is committed
+        every few orders. Without savepoints the error is raised, and
+        nothing the failed order wrote is committed.
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        ChannelException = POOL.get('channel.exception')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.channel1.magento_orders_per_commit = 1
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            def multicall(calls):
+                # The data of the second order is broken
+                results = mock_order_multicall(calls)
+                del results[1]['items']
+                return results
+
+            order_api = mock_order_api()
+            order_api.return_value.multiCall.side_effect = multicall
+            with Transaction().set_context({
+                'company': self.company.id,
+                'current_channel': self.channel1.id,
+            }):
+                with patch('magento.Order', order_api, create=True):
+                    with patch(
+                        'magento.Customer', mock_customer_api(), create=True
+                    ):
+                        with patch(
+                            'magento.Product', mock_product_api(),
+                            create=True
+                        ):
+                            with patch.object(
+                                Transaction().cursor, 'commit'
+                            ) as commit:
+                                import_orders = functools.partial(
+                                    self.channel1
+                                    .import_orders_using_magento_data, [{
+                                        'order_id': '4',
+                                        'increment_id': '100000004',
+                                    }, {
+                                        'order_id': '1',
+                                        'increment_id': '100000001',
+                                    }]
+                                )
+                                if not channel.has_savepoint():
+                                    self.assertRaises(KeyError, import_orders)
+                                    # Only the slice of the first order is
+                                    # committed
+                                    self.assertEqual(commit.call_count, 1)
+                                    return
+                                sales = import_orders()
+
+            sale, = sales
+            self.assertEqual(sale.reference, 'mag_100000004')
+            self.assertEqual(Sale.search_count([]), 1)
+            # A commit after each slice of one order
+            self.assertEqual(commit.call_count, 2)
+
+            exception, = ChannelException.search([
+                ('channel', '=', self.channel1.id),
+            ])
+            self.assertTrue('100000001' in exception.log)
+            self.assertTrue('KeyError' in exception.log)
+
+    def test_0170_import_orders_fetched_concurrently(self):
+        """
+        Tests that orders fetched concurrently are imported in the order
+        of the order summaries
+        """
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.channel1.magento_multicall_batch_size = 1
+            self.channel1.magento_order_fetch_concurrency = 2
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            order_api = mock_order_api()
+            with Transaction().set_context({
+                'company': self.company.id,
+                'current_channel': self.channel1.id,
+            }):
+                with patch('magento.Order', order_api, create=True):
+                    with patch(
+                        'magento.Customer', mock_customer_api(), create=True
+                    ):
+                        with patch(
+                            'magento.Product', mock_product_api(),
+                            create=True
+                        ):
+                            sales = self.channel1 \
+                                .import_orders_using_magento_data([{
+                                    'order_id': '4',
+                                    'increment_id': '100000004',
+                                }, {
+                                    'order_id': '99',
+                                    'increment_id': '100000099',
+                                }, {
+                                    'order_id': '1',
+                                    'increment_id': '100000001',
+                                }])
+
+            self.assertEqual(
+                [sale.reference for sale in sales],
+                ['mag_100000004', 'mag_100000001']
+            )
+            self.assertEqual(order_api.return_value.multiCall.call_count, 3)
+
+    def test_0180_import_orders_in_stages(self):
+        """
+        Tests that orders downloaded into payloads can be turned into sales
+        later without connecting to magento
+        """
+        Sale = POOL.get('sale.sale')
+        Category = POOL.get('product.category')
+        Payload = POOL.get('magento.order.payload')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            order_api = mock_order_api()
+            order_api.return_value.search.return_value = {
+                'hasNext': False,
+                'items': [{
+                    'order_id': '1', 'increment_id': '100000001',
+                }],
+            }
+            with patch('magento.Order', order_api, create=True):
+                with patch.object(Transaction().cursor, 'commit'):
+                    payload, = self.channel1.download_magento_orders()
+
+            self.assertEqual(payload.increment_id, '100000001')
+            self.assertEqual(payload.state, 'pending')
+            self.assertEqual(
+                payload.get_order_data(), load_json('orders', '100000001')
+            )
+            self.assertEqual(Sale.search_count([]), 0)
+
+            with Transaction().set_context(company=self.company.id):
+                with patch(
+                    'magento.Customer', mock_customer_api(), create=True
+                ):
+                    with patch(
+                        'magento.Product', mock_product_api(), create=True
+                    ):
+                        with patch.object(Transaction().cursor, 'commit'):
+                            sale, = self.channel1 \
+                                .process_magento_order_payloads()
+
+                            # Processed payloads are not processed again
+                            self.assertEqual(
+                                self.channel1.process_magento_order_payloads(),
+                                []
+                            )
+
+            self.assertEqual(sale.reference, 'mag_100000001')
+            payload = Payload(payload.id)
+            self.assertEqual(payload.state, 'done')
+            self.assertEqual(payload.sale, sale)
+            self.assertEqual(order_api.return_value.multiCall.call_count, 1)
+
+    def test_0190_import_orders_paginated_by_order_id(self):
+        """
+        Tests that orders are paginated by order id without page offsets
+        and that the import starts from the latest update time of the
+        orders imported
+        """
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.channel1.magento_order_pagination = 'keyset'
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            orders_summaries = [{
+                'order_id': '1', 'increment_id': '100000001',
+                'updated_at': '2015-01-02 10:00:00',
+            }, {
+                'order_id': '4', 'increment_id': '100000004',
+                'updated_at': '2015-01-01 10:00:00',
+            }]
+            searches = []
+
+            def search(filters, limit):
+                searches.append(dict(filters))
+                return {
+                    'items': [
+                        order_summary for order_summary in orders_summaries
+                        if int(order_summary['order_id']) >
+                        filters['order_id']['gt']
+                    ][:limit],
+                }
+
+            order_api = mock_order_api()
+            order_api.return_value.search.side_effect = search
+            with Transaction().set_context(company=self.company.id):
+                with patch('magento.Order', order_api, create=True):
+                    with patch(
+                        'magento.Customer', mock_customer_api(), create=True
+                    ):
+                        with patch(
+                            'magento.Product', mock_product_api(),
+                            create=True
+                        ):
+                            with patch.object(
+                                channel, 'ORDER_PAGE_SIZE', 1
+                            ):
+                                with patch.object(
+                                    Transaction().cursor, 'commit'
+                                ):
+                                    sales = self.channel1.import_orders()
+
+                                    # The next import starts from the
+                                    # latest update of the orders
+                                    searches[:] = []
+                                    self.channel1.import_orders()
+
+            self.assertEqual(len(sales), 2)
+            self.assertEqual(
+                self.channel1.magento_last_order_updated_at,
+                datetime(2015, 1, 2, 10, 0, 0)
+            )
+            self.assertIsNone(self.channel1.magento_last_order_id)
+            self.assertEqual(
+                searches[0]['updated_at'], {'gteq': '2015-01-02 10:00:00'}
+            )
+            self.assertEqual(searches[0]['order_id'], {'gt': 0})
+            self.assertEqual(searches[1]['order_id'], {'gt': 1})
+
+    def test_0195_keyset_import_sees_orders_updated_while_running(self):
+        """
+        Tests that an order updated while orders paginated by order id are
+        imported is found by the next import, even when an order of a later
+        page was updated after it, and that orders not listed by order id
+        raise an error
+        """
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.channel1.magento_order_pagination = 'keyset'
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            fake = FakeMagento(orders=3, customers=2, products=3)
+            first_order, _, last_order = fake.orders.values()
+            search = fake.sales_order_search
+            searched_ids = []
+
+            def search_and_update(options):
+                result = search(options)
+                searched_ids.append(
+                    [item['order_id'] for item in result['items']]
+                )
+                if len(searched_ids) == 1:
+                    # The first order is updated once its page is read,
+                    # before the last order is updated
+                    now = datetime.utcnow()
+                    first_order['updated_at'] = now.strftime(
+                        '%Y-%m-%d %H:%M:%S'
+                    )
+                    last_order['updated_at'] = (
+                        now + relativedelta(minutes=1)
+                    ).strftime('%Y-%m-%d %H:%M:%S')
+                return result
+            fake.sales_order_search = search_and_update
+
+            with Transaction().set_context(company=self.company.id):
+                with patch('magento.Order', stand_in(fake, magento.Order)):
+                    with patch(
+                        'magento.Customer', stand_in(fake, magento.Customer)
+                    ):
+                        with patch(
+                            'magento.Product',
+                            stand_in(fake, magento.Product)
+                        ):
+                            with patch.object(
+                                channel, 'ORDER_PAGE_SIZE', 1
+                            ):
+                                with patch.object(
+                                    Transaction().cursor, 'commit'
+                                ):
+                                    sales = self.channel1.import_orders()
+                                    self.assertEqual(len(sales), 3)
+
+                                    searched_ids[:] = []
+                                    self.channel1.import_orders()
+                                    self.assertEqual(
+                                        searched_ids[0], ['1']
+                                    )
+
+                                    fake.sales_order_search = lambda o: {
+                                        'items': list(reversed(
+                                            search(o)['items']
+                                        )),
+                                    }
+                                    with patch.object(
+                                        channel, 'ORDER_PAGE_SIZE', 3
+                                    ):
+                                        self.assertRaises(
+                                            UserError,
+                                            self.channel1.import_orders
+                                        )
+
+    def test_0200_import_orders_from_fake_magento(self):
+        """
+        Tests the import of synthetic orders through the python-magento
+        client, using the fake magento of the benchmarks
+        """
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            fake = FakeMagento(orders=3, customers=2, products=3)
+            with Transaction().set_context(company=self.company.id):
+                with patch('magento.Order', stand_in(fake, magento.Order)):
+                    with patch(
+                        'magento.Customer', stand_in(fake, magento.Customer)
+                    ):
+                        with patch(
+                            'magento.Product',
+                            stand_in(fake, magento.Product)
+                        ):
+                            with patch.object(
+                                Transaction().cursor, 'commit'
+                            ):
+                                sales = self.channel1.import_orders()
+
+            self.assertEqual(len(sales), 3)
+            self.assertEqual(
+                len(set(sale.party for sale in sales)), 2
+            )
+            self.assertEqual(fake.calls['sales_order.info'], 3)
+            # Both customers are fetched in a single list
+            self.assertEqual(fake.calls['customer.list'], 1)
+            self.assertEqual(fake.calls['customer.info'], 0)
+            self.assertEqual(fake.calls['catalog_product.info'], 3)
+
+    def test_0210_import_orders_over_xmlrpc(self):
+        """
+        Tests the import of orders from the fake magento served over
+        XML-RPC, with the orders fetched concurrently
+        """
+        Category = POOL.get('product.category')
+
+        fake = FakeMagento(orders=4, customers=2, products=3)
+        server = FakeMagentoServer(fake)
+        server.start()
+        self.addCleanup(server.shutdown)
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.channel1.magento_url = server.url
+            self.channel1.magento_multicall_batch_size = 2
+            self.channel1.magento_order_fetch_concurrency = 2
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            with Transaction().set_context(company=self.company.id):
+                with patch.object(Transaction().cursor, 'commit'):
+                    sales = self.channel1.import_orders()
+
+            self.assertEqual(
+                sorted(sale.magento_id for sale in sales), range(1, 5)
+            )
+            self.assertEqual(fake.calls['sales_order.info'], 4)
+            # The four orders are fetched in two multiCalls
+            self.assertEqual(
+                fake.requests, sum(fake.calls.values()) - 4 + 2
+            )
+
+    def test_0220_import_orders_when_customer_list_fails(self):
+        """
+        Tests that with periodic commits the customers are fetched with
+        their orders when they cannot be listed
+        """
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.channel1.magento_orders_per_commit = 2
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            fake = FakeMagento(orders=3, customers=3, products=3)
+            fake.customer_list = MagicMock(side_effect=xmlrpclib.Fault(
+                1, 'Internal Error. Please see log for details.'
+            ))
+            with Transaction().set_context(company=self.company.id):
+                with patch('magento.Order', stand_in(fake, magento.Order)):
+                    with patch(
+                        'magento.Customer', stand_in(fake, magento.Customer)
+                    ):
+                        with patch(
+                            'magento.Product',
+                            stand_in(fake, magento.Product)
+                        ):
+                            with patch.object(
+                                Transaction().cursor, 'commit'
+                            ):
+                                sales = self.channel1.import_orders()
+
+            self.assertEqual(len(sales), 3)
+            self.assertEqual(
+                len(set(sale.party for sale in sales)), 3
+            )
+            # One list per slice of orders, then each customer on its own
+            self.assertEqual(fake.calls['customer.list'], 2)
+            self.assertEqual(fake.calls['customer.info'], 3)
+
+    def test_0230_import_orders_of_merged_guests(self):
+        """
+        Tests that the orders of guests with the same email are imported
+        for a single party when guest customers are merged
+        """
+        Category = POOL.get('product.category')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+            self.channel1.magento_merge_guest_customers = True
+            self.channel1.save()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            fake = FakeMagento(orders=4, customers=2, products=3)
+            for order in fake.orders.values():
+                order['customer_id'] = None
+                order['customer_email'] = order['customer_email'].upper()
+            with Transaction().set_context(company=self.company.id):
+                with patch('magento.Order', stand_in(fake, magento.Order)):
+                    with patch(
+                        'magento.Customer', stand_in(fake, magento.Customer)
+                    ):
+                        with patch(
+                            'magento.Product',
+                            stand_in(fake, magento.Product)
+                        ):
+                            with patch.object(
+                                Transaction().cursor, 'commit'
+                            ):
+                                sales = self.channel1.import_orders()
+
+            self.assertEqual(len(sales), 4)
+            self.assertEqual(
+                sorted(set(
+                    sale.party.magento_ids[0].guest_email for sale in sales
+                )), ['customer1@example.com', 'customer2@example.com']
+            )
+            self.assertEqual(len(set(sale.party for sale in sales)), 2)
+            self.assertEqual(fake.calls['customer.list'], 0)
+
+    def test_0240_import_orders_skips_canceled_orders(self):
+        """
+        Tests that an order in a state which is not imported is skipped
+        without stopping the import of the other orders
+        """
+        Category = POOL.get('product.category')
+        Payload = POOL.get('magento.order.payload')
+
+        with Transaction().start(DB_NAME, USER, CONTEXT):
+            self.setup_defaults()
+
+            with Transaction().set_context({
+                'current_channel': self.channel1.id,
+            }):
+                order_states_list = load_json('order-states', 'all')
+                for code, name in order_states_list.iteritems():
+                    self.channel1.create_order_state(code, name)
+
+                category_tree = load_json('categories', 'category_tree')
+                Category.create_tree_using_magento_data(category_tree)
+
+            fake = FakeMagento(orders=3, customers=2, products=3)
+            fake.orders.values()[1]['state'] = 'canceled'
+            with Transaction().set_context(company=self.company.id):
+                with patch('magento.Order', stand_in(fake, magento.Order)):
+                    with patch(
+                        'magento.Customer', stand_in(fake, magento.Customer)
+                    ):
+                        with patch(
+                            'magento.Product',
+                            stand_in(fake, magento.Product)
+                        ):
+                            with patch.object(
+                                Transaction().cursor, 'commit'
+                            ):
+                                sales = self.channel1.import_orders()
+
+            self.assertEqual(
+                sorted(sale.magento_id for sale in sales), [1, 3]
+            )
+            payload, = Payload.search([('state', '=', 'skipped')])
+            self.assertEqual(
+                payload.increment_id, fake.orders.values()[1]['increment_id']
+            )
+            self.assertIsNone(payload.sale)
+            self.assertEqual(Payload.search([], count=True), 3)
+
 
 def suite():
     """
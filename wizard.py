@@ -359,10 +359,7 @@ class ConfigureMagento(Wizard):
         """
         magento_channel = self.start.channel
 
-        with Core(
-            magento_channel.magento_url, magento_channel.magento_api_user,
-            magento_channel.magento_api_key
-        ) as core_api:
+        with magento_channel.get_magento_session(Core) as core_api:
             websites = core_api.websites()
 
         selection = []
@@ -387,10 +384,7 @@ class ConfigureMagento(Wizard):
 
         selected_website = json.loads(self.import_website.magento_websites)
 
-        with Core(
-            magento_channel.magento_url, magento_channel.magento_api_user,
-            magento_channel.magento_api_key
-        ) as core_api:
+        with magento_channel.get_magento_session(Core) as core_api:
             stores = core_api.stores(selected_website['id'])
 
         all_stores = []
@@ -509,19 +503,13 @@ class UpdateMagentoCatalog(Wizard):
 
     def update_products(self, channel):
         """
-        Updates products for current magento_channel
+        Updates the products of the channel which changed on magento since
+        the last update
 
         :param channel: Browse record of channel
         :return: List of product IDs
         """
-        products = []
-        with Transaction().set_context({'current_channel': channel.id}):
-            for listing in channel.product_listings:
-                products.append(
-                    listing.product.update_from_magento()
-                )
-
-        return map(int, products)
+        return map(int, channel.update_magento_products())
 
 
 class ExportMagentoCatalogStart(ModelView):
@@ -554,9 +542,8 @@ class ExportMagentoCatalogStart(ModelView):
         channel = Channel(Transaction().context['active_id'])
         channel.validate_magento_channel()
 
-        with magento.ProductAttributeSet(
-            channel.magento_url, channel.magento_api_user,
-            channel.magento_api_key
+        with channel.get_magento_session(
+            magento.ProductAttributeSet
         ) as attribute_set_api:
             attribute_sets = attribute_set_api.list()
 